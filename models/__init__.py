@@ -1,7 +1,16 @@
 # -*- coding: utf-8 -*-
 
 from . import models
+from . import remote_connection
+from . import remote_circuit_breaker
+from . import remote_rate_limit
+from . import remote_id_map
+from . import remote_sync_job
+from . import remote_sync_channel
+from . import remote_sync_watermark
 from . import account
+# Not loaded: they extend point_of_sale and the item.requisition module,
+# which are not dependencies of this module
 # from . import pos_session
 # from . import requisitions
 from . import journal_entry
@@ -10,6 +10,8 @@ import logging
 _logger = logging.getLogger(__name__)
 import time
 
+# Endpoint of the main database creating and posting both legs of internal transfers
+INTERNAL_TRANSFER_ENDPOINT = 'remote_create_internal_transfers'
 
 
 class AccountPayment(models.Model):
@@ -18,8 +20,28 @@ class AccountPayment(models.Model):
     payment_posted_to_remote = fields.Boolean("Payment Posted to remote", copy=False)
     failed_to_sync = fields.Boolean("Failed To Sync", copy=False)
     remote_id = fields.Integer(string="Remote Id", copy=False)
+    remote_payload_hash = fields.Char(string="Remote Payload Hash", copy=False, readonly=True)
+    remote_sync_in_doubt = fields.Boolean("Remote Creation In Doubt", copy=False, readonly=True,
+                                          help="The last create call got no answer: the remote records may exist.")
     no_allow_sync = fields.Boolean("Not Allow Sync")
 
+    def init(self):
+        super().init()
+        # Only the payments still to send, the date and state are read from their move
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_payment_remote_sync_pending_idx
+            ON account_payment (is_internal_transfer, payment_type, move_id)
+            WHERE (payment_posted_to_remote IS NULL OR payment_posted_to_remote = false)
+              AND (no_allow_sync IS NULL OR no_allow_sync = false)
+        """)
+
+    def action_post(self):
+        result = super(AccountPayment, self).action_post()
+        # Queue the payments for the payment and internal transfer crons
+        job_obj = self.env['remote.sync.job'].sudo()
+        job_obj._enqueue_eligible(self, 'payment')
+        job_obj._enqueue_eligible(self, 'internal_transfer')
+        return result
     
     @api.model
     def send_internal_transfer_payment_to_remote(self):
@@ -39,39 +61,209 @@ class AccountPayment(models.Model):
             raise ValidationError("Remote server settings must be fully configured (URL, DB, Username, Password)")
 
         try:
-            common = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/common', allow_none=True)
-            uid = common.authenticate(db, username, password, {})
-            models = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/object', allow_none=True)
-
-            start_date = date(2024, 7, 1).isoformat()
-            payments = self.search([
-                ('payment_posted_to_remote', '=', False),
-                ('no_allow_sync', '=', False),
-                ('is_internal_transfer', '=', True),
-                ('date', '>=', start_date),
-                ('state', '=', 'posted'),
-                ('payment_type', '=', 'outbound'),
-            ], limit=5, order='date asc')
-
-            for payment in payments:
-                try:
-                    payment_data = payment._prepare_internal_transfer_payment_data(models, db, uid, password)
-                    _logger.info("Sending Payment Data: %s", payment_data)
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
+
+            # Consume the internal transfers queued for the remote
+            job_obj = self.env['remote.sync.job'].sudo()
+            jobs = job_obj._claim_jobs('internal_transfer', limit=5)
+            with jobs._fail_on_error():
+                payments = jobs._get_records('account.payment').filtered_domain(
+                    job_obj._get_channel_domains()['internal_transfer'][1]).sorted('date')
+
+                if payments and models.has_method('account.payment', INTERNAL_TRANSFER_ENDPOINT):
+                    try:
+                        payments._send_internal_transfers_bulk(models, db, uid, password)
+                        payments = self.browse()
+                    except Exception as e:
+                        if not models.is_missing_method(e, 'account.payment', INTERNAL_TRANSFER_ENDPOINT):
+                            _logger.error("Error sending %s internal transfers to remote: %s", len(payments), str(e))
+                            payments._mark_remote_sync_failed(e)
+                            payments = self.browse()
+
+                # Main databases without the endpoint: one call per step
+                for payment in payments:
+                    try:
+                        payment_data = payment._prepare_internal_transfer_payment_data(models, db, uid, password)
+                        _logger.info("Sending Payment Data: %s", payment_data)
+
+                        outbound_payment_id = models.execute_kw(db, uid, password, 
+                                                                'account.bank.statement.line', 'create', [payment_data])
+
+                        payment.write({'payment_posted_to_remote': True, 'remote_id': outbound_payment_id})
+                        _logger.info("Outbound Payment Created on Remote: %s", outbound_payment_id)
+
+                        payment._reconcile_internal_transfer_payment(models, db, uid, password, outbound_payment_id)
+
+                    except Exception as e:
+                        _logger.error("Error processing payment ID %s: %s", payment.id, str(e))
+                        payment.message_post(body="Error processing payment ID {}: {}".format(payment.id, str(e)))
+                        payment._mark_remote_sync_failed(e)
+
+                jobs.filtered(lambda j: j.state == 'running')._set_done()
+
+        except Exception as e:
+            raise ValidationError(f"Error while sending payment data to remote server: {e}")
 
-                    outbound_payment_id = models.execute_kw(db, uid, password, 
-                                                            'account.bank.statement.line', 'create', [payment_data])
+    def _mark_remote_sync_failed(self, error):
+        """ Record the failure on the creation jobs of the payments; the ones no
+        retry was scheduled for are flagged as failed so that the scans leave
+        them alone. """
+        job_obj = self.env['remote.sync.job'].sudo()
+        for payment in self:
+            if not job_obj._record_failed(payment, error, actions=['create']):
+                payment.write({'failed_to_sync': True})
+
+    def _send_internal_transfers_bulk(self, models, db, uid, password):
+        """ Create both legs of the internal transfers of ``self`` on the main
+        database with a single call to its ``remote_create_internal_transfers``.
+
+        If the call gets no answer, the main database may have created the
+        transfers: they are flagged as in doubt, and the next attempt adopts
+        the statement lines it finds instead of creating them again. """
+        transfers = []
+        payments = self.browse()
+        for payment in self:
+            try:
+                transfers.append({
+                    'outbound': payment._prepare_internal_transfer_payment_data(models, db, uid, password),
+                    'inbound': payment._prepare_internal_transfer_inbound_data(models, db, uid, password),
+                })
+            except Exception as e:
+                _logger.error("Error processing payment ID %s: %s", payment.id, str(e))
+                payment._mark_remote_sync_failed(e)
+                continue
+            payments |= payment
+        payments, transfers = payments._adopt_remote_transfers(models, db, uid, password, transfers)
+        if not transfers:
+            return
 
-                    payment.write({'payment_posted_to_remote': True, 'remote_id': outbound_payment_id})
-                    _logger.info("Outbound Payment Created on Remote: %s", outbound_payment_id)
+        payments.write({'remote_sync_in_doubt': True})
+        self.env.cr.commit()
+        try:
+            results = models.execute_kw(db, uid, password, 'account.payment', INTERNAL_TRANSFER_ENDPOINT, [transfers])
+        except Exception as e:
+            if isinstance(e, xmlrpc.client.Fault) or self.env['remote.sync.job']._is_refused_call(e):
+                # The main database rolled the call back, or it was never sent
+                payments.write({'remote_sync_in_doubt': False})
+            raise
+        for payment, result in zip(payments, results):
+            if result.get('error'):
+                payment.write({'remote_sync_in_doubt': False})
+                _logger.error("Error processing payment ID %s: %s", payment.id, result['error'])
+                payment.message_post(body="Error processing payment ID {}: {}".format(payment.id, result['error']))
+                payment._mark_remote_sync_failed(ValidationError(result['error']))
+                continue
+            payment._set_remote_transfer(result['outbound_id'], result['inbound_id'])
+            _logger.info("Internal transfer created on remote: Outbound %s - Inbound %s",
+                         result['outbound_id'], result['inbound_id'])
+
+    def _set_remote_transfer(self, outbound_id, inbound_id):
+        self.write({'payment_posted_to_remote': True, 'remote_id': outbound_id, 'remote_sync_in_doubt': False})
+        self.paired_internal_transfer_payment_id.write({
+            'remote_id': inbound_id,
+            'payment_posted_to_remote': True,
+        })
+
+    def _adopt_remote_transfers(self, models, db, uid, password, transfers):
+        """ Look on the main database for the statement lines of the transfers of
+        ``self`` (``transfers`` in the same order) whose last call got no answer,
+        matching both legs on journal, date, amount and reference. The transfers
+        found with lines no other payment is mapped to are adopted instead of
+        being sent again.
+
+        Return the payments and transfers still to send. """
+        in_doubt = [transfer for payment, transfer in zip(self, transfers) if payment.remote_sync_in_doubt]
+        if not in_doubt:
+            return self, transfers
+        legs = [transfer[leg] for transfer in in_doubt for leg in ('outbound', 'inbound')]
+
+        def leg_key(journal_id, leg_date, amount, payment_ref):
+            return journal_id, str(leg_date), round(amount, 2), payment_ref or False
+
+        def transfer_leg_key(leg):
+            return leg_key(leg['journal_id'], leg['date'], leg['amount'], leg['payment_ref'])
+
+        candidates = models.execute_kw(db, uid, password, 'account.bank.statement.line', 'search_read', [[
+            ('journal_id', 'in', list({leg['journal_id'] for leg in legs})),
+            ('date', 'in', list({leg['date'] for leg in legs})),
+        ]], {'fields': ['journal_id', 'date', 'amount', 'payment_ref']})
+        mapped = set(self.sudo().search([
+            ('is_internal_transfer', '=', True), ('remote_id', 'in', [candidate['id'] for candidate in candidates]),
+        ]).mapped('remote_id'))
+        available = {}
+        for candidate in candidates:
+            if candidate['id'] not in mapped:
+                available.setdefault(leg_key(
+                    candidate['journal_id'][0], candidate['date'], candidate['amount'], candidate['payment_ref'],
+                ), []).append(candidate['id'])
+
+        payments, remaining = self.browse(), []
+        for payment, transfer in zip(self, transfers):
+            if payment.remote_sync_in_doubt:
+                outbound_ids = available.get(transfer_leg_key(transfer['outbound']))
+                inbound_ids = available.get(transfer_leg_key(transfer['inbound']))
+                # Both legs are created in the same savepoint, they exist together or not at all
+                if outbound_ids and inbound_ids:
+                    payment._set_remote_transfer(outbound_ids.pop(0), inbound_ids.pop(0))
+                    _logger.info("Adopted remote internal transfer %s for payment ID %s", payment.remote_id, payment.id)
+                    continue
+            payments |= payment
+            remaining.append(transfer)
+        return payments, remaining
 
-                    payment._reconcile_internal_transfer_payment(models, db, uid, password, outbound_payment_id)
+    @api.model
+    def remote_create_internal_transfers(self, transfers):
+        """ Endpoint of the main database: create each of the ``transfers`` sent
+        by a branch, a ``{'outbound': vals, 'inbound': vals}`` dict of bank
+        statement line values, and post both legs with their suspense line
+        moved to the liquidity transfer account of the company.
+
+        Return, in the same order, ``{'outbound_id': id, 'inbound_id': id}`` or
+        ``{'error': message}``; a failed transfer is rolled back alone.
+        """
+        remote_type = self.env['ir.config_parameter'].sudo().get_param('remote_operations.remote_type')
+        if remote_type != 'Main Database':
+            raise UserError(_("Internal transfers can only be received by the Main Database."))
 
-                except Exception as e:
-                    _logger.error("Error processing payment ID %s: %s", payment.id, str(e))
-                    payment.message_post(body="Error processing payment ID {}: {}".format(payment.id, str(e)))
+        results = []
+        for transfer in transfers:
+            try:
+                with self.env.cr.savepoint():
+                    outbound = self._create_internal_transfer_leg(transfer['outbound'], 'from')
+                    inbound = self._create_internal_transfer_leg(transfer['inbound'], 'to')
+            except Exception as e:
+                _logger.warning("Internal transfer %s could not be created: %s", transfer, str(e))
+                results.append({'error': str(e)})
+                continue
+            results.append({'outbound_id': outbound.id, 'inbound_id': inbound.id})
+        return results
 
-        except Exception as e:
-            raise ValidationError(f"Error while sending payment data to remote server: {e}")
+    @api.model
+    def _create_internal_transfer_leg(self, vals, direction):
+        """ Create one leg of an internal transfer and repost its move with the
+        suspense line on the liquidity transfer account. """
+        statement_line = self.env['account.bank.statement.line'].create(vals)
+        move = statement_line.move_id
+        journal = statement_line.journal_id
+
+        transfer_account = move.company_id.transfer_account_id
+        if not transfer_account:
+            raise ValidationError(_("Liquidity Transfer Account is not configured for %s!") % move.company_id.name)
+        if not journal.suspense_account_id:
+            raise ValidationError(_("No suspense account defined for journal %s!") % journal.name)
+        suspense_line = move.line_ids.filtered(lambda l: l.account_id == journal.suspense_account_id)[:1]
+        if not suspense_line:
+            raise ValidationError(_("No suspense line found in move %s!") % move.name)
+
+        if move.state == 'posted':
+            move.button_draft()
+        suspense_line.write({
+            'account_id': transfer_account.id,
+            'name': f"Internal Transfer {direction} {journal.name}",
+        })
+        move.action_post()
+        return statement_line
 
     def _prepare_internal_transfer_payment_data(self, models, db, uid, password):
         """Prepare the outbound payment data for Odoo 18."""
@@ -86,19 +278,23 @@ class AccountPayment(models.Model):
             'company_id': self._map_branch_to_remote_company(models, db, uid, password, self.branch_id, self.company_id) or None,
         }
     
+    def _prepare_internal_transfer_inbound_data(self, models, db, uid, password):
+        """Prepare the inbound statement line data, in the destination journal."""
+        currency_id = self._get_remote_id_if_set(models, db, uid, password, 'res.currency', 'name', self.currency_id)
+        return {
+            'journal_id': self._map_journal_to_remote_company(models, db, uid, password, self.destination_journal_id),
+            'currency_id': currency_id or None,
+            'amount': self.amount,  # Inbound payment is positive
+            'date': self.date.isoformat() if self.date else None,
+            'payment_ref': f"Internal Transfer from {self.journal_id.name}",
+            'company_id': self._map_branch_to_remote_company(models, db, uid, password, self.branch_id, self.company_id) or None,
+        }
+
     def _reconcile_internal_transfer_payment(self, models, db, uid, password, outbound_payment_id):
         """Reconcile outbound and inbound separately with liquidity handling."""
         for rec in self:
-            currency_id = self._get_remote_id_if_set(models, db, uid, password, 'res.currency', 'name', self.currency_id)
             # Create inbound payment in destination journal
-            inbound_statement_vals = {
-                'journal_id': self._map_journal_to_remote_company(models, db, uid, password, self.destination_journal_id),
-                'currency_id': currency_id or None,
-                'amount': rec.amount,  # Inbound payment is positive
-                'date': rec.date.isoformat() if rec.date else None,
-                'payment_ref': f"Internal Transfer from {rec.journal_id.name}",
-                'company_id': self._map_branch_to_remote_company(models, db, uid, password, self.branch_id, self.company_id) or None,
-            }
+            inbound_statement_vals = rec._prepare_internal_transfer_inbound_data(models, db, uid, password)
             _logger.info("Inbound Payment Data: %s", inbound_statement_vals)
 
             inbound_payment_id = models.execute_kw(db, uid, password, 
@@ -247,13 +443,12 @@ class AccountPayment(models.Model):
             raise UserError(_("Remote server settings must be fully configured (URL, DB, Username, Password)"))
 
         try:
-            common = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/common', allow_none=True)
-            uid = common.authenticate(db, username, password, {})
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
             if not uid:
                 raise UserError(_("Authentication failed with remote server."))
 
-            models = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/object', allow_none=True)
-            start_date = fields.Date.to_date('2024-07-01')
+            start_date = self.env['remote.sync.watermark']._get_start_date()
 
             for payment in self:
                 try:
@@ -279,7 +474,8 @@ class AccountPayment(models.Model):
 
                     payment.write({
                         'payment_posted_to_remote': True,
-                        'remote_id': new_payment_id
+                        'remote_id': new_payment_id,
+                        'remote_payload_hash': self.env['remote.connection']._payload_hash(payment_data),
                     })
                     self.env.cr.commit()
 
@@ -315,39 +511,38 @@ class AccountPayment(models.Model):
             raise ValidationError("Remote server settings must be fully configured (URL, DB, Username, Password)")
 
         try:
-            common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(url), allow_none=True)
-            uid = common.authenticate(db, username, password, {})
-            models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(url), allow_none=True)
-
-            start_date = date(2024, 7, 1).isoformat()
-            payments = self.search([
-                ('payment_posted_to_remote', '=', False),
-                ('no_allow_sync', '=', False),
-                ('is_internal_transfer', '=', False),
-                ('date', '>=', start_date),
-                ('state', '=', 'posted'),
-                # ('remote_id', '=', 0)
-            ], limit=10, order='date asc')
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
+
+            # Consume the payments queued for the remote
+            job_obj = self.env['remote.sync.job'].sudo()
+            jobs = job_obj._claim_jobs('payment', limit=10)
+            with jobs._fail_on_error():
+                payments = jobs._get_records('account.payment').filtered_domain(
+                    job_obj._get_channel_domains()['payment'][1]).sorted('date')
             
-            for payment in payments:
-                try:
-                    move_id = payment.move_id
-                    payment_data = payment._prepare_payment_data(models, db, uid, password)
-                    _logger.info("Payment Data: %s", payment_data)
-                    new_payment_id = models.execute_kw(db, uid, password, 'account.payment', 'create', [payment_data])
-                    payment.write({'payment_posted_to_remote': True, 'remote_id': new_payment_id})
-                    if payment.move_id:
-                        payment.move_id.write({'posted_to_remote': True})  
-                    models.execute_kw(db, uid, password, 'account.payment', 'action_post', [[new_payment_id]])
-                    _logger.info("Payment Has been created *********************: %s", new_payment_id)
-                    payment.message_post(body="Payment Has been created ")
-
-
-                except Exception as e:
-                    # payment.write({'failed_to_sync': True})
-                    _logger.error("Error processing payment ID %s: %s", payment.id, str(e))
-                    payment.message_post(body="Error processing payment ID {}: {}".format(payment.id, str(e)))
-
+                for payment in payments:
+                    try:
+                        move_id = payment.move_id
+                        payment_data = payment._prepare_payment_data(models, db, uid, password)
+                        _logger.info("Payment Data: %s", payment_data)
+                        new_payment_id = models.execute_kw(db, uid, password, 'account.payment', 'create', [payment_data])
+                        payment.write({'payment_posted_to_remote': True, 'remote_id': new_payment_id,
+                                       'remote_payload_hash': self.env['remote.connection']._payload_hash(payment_data)})
+                        if payment.move_id:
+                            payment.move_id.write({'posted_to_remote': True})  
+                        models.execute_kw(db, uid, password, 'account.payment', 'action_post', [[new_payment_id]])
+                        _logger.info("Payment Has been created *********************: %s", new_payment_id)
+                        payment.message_post(body="Payment Has been created ")
+
+
+                    except Exception as e:
+                        # payment.write({'failed_to_sync': True})
+                        _logger.error("Error processing payment ID %s: %s", payment.id, str(e))
+                        payment.message_post(body="Error processing payment ID {}: {}".format(payment.id, str(e)))
+                        payment._mark_remote_sync_failed(e)
+
+                jobs.filtered(lambda j: j.state == 'running')._set_done()
 
         except Exception as e:
             raise ValidationError("Error while sending payment data to remote server: {}".format(e))
@@ -358,7 +553,6 @@ class AccountPayment(models.Model):
         if not partner_id and self.partner_id:
             # Create the partner in the remote system if it doesn't exist
             partner_id = self._create_remote_partner(models, db, uid, password, self.partner_id)
-        journal_id = self._get_remote_id(models, db, uid, password, 'account.journal', 'name', self.journal_id.name)
         currency_id = self._get_remote_id_if_set(models, db, uid, password, 'res.currency', 'name', self.currency_id)
         payment_data = {
             'partner_id': partner_id,
@@ -474,9 +668,9 @@ class AccountPayment(models.Model):
             raise ValueError("Either branch_id or company_id must be provided to map to a remote company.")
 
         # Map to the remote company by name or another unique field
-        remote_company_id = self._get_remote_id(
-            models, db, uid, password,
-            'res.company', 'name', local_company.name
+        remote_company_id = self.env['remote.id.map']._resolve(
+            models, local_company,
+            lambda: self._get_remote_id(models, db, uid, password, 'res.company', 'name', local_company.name)
         )
 
         return remote_company_id
@@ -498,13 +692,16 @@ class AccountPayment(models.Model):
             local_company_id = local_journal.company_id.id
         
             # Map to the remote company journal by name and company
-            remote_journal_id = self._get_remote_journal_id(
-                models, db, uid, password,
-                'account.journal', 
-                domain=[
-                    ('name', '=', local_journal.name),
-                    ('company_id', '=', local_company_id)
-                ]
+            remote_journal_id = self.env['remote.id.map']._resolve(
+                models, local_journal,
+                lambda: self._get_remote_journal_id(
+                    models, db, uid, password,
+                    'account.journal',
+                    domain=[
+                        ('name', '=', local_journal.name),
+                        ('company_id', '=', local_company_id)
+                    ]
+                )
             )
 
         return remote_journal_id
@@ -535,7 +732,10 @@ class AccountPayment(models.Model):
     
     def _get_remote_id_if_set(self, models, db, uid, password, model, field_name, field):
         if field:
-            return self._get_remote_id(models, db, uid, password, model, field_name, field.name)
+            return self.env['remote.id.map']._resolve(
+                models, field,
+                lambda: self._get_remote_id(models, db, uid, password, model, field_name, field.name)
+            )
         return False
     
     def _create_remote_partner(self, models, db, uid, password, partner):
@@ -565,7 +765,9 @@ class AccountPayment(models.Model):
             'property_account_payable_id': property_account_payable_id,
 
         }
-        return models.execute_kw(db, uid, password, 'res.partner', 'create', [partner_data])
+        remote_partner_id = models.execute_kw(db, uid, password, 'res.partner', 'create', [partner_data])
+        self.env['remote.id.map']._store(models, partner, remote_partner_id)
+        return remote_partner_id
 
 
 # class AccountPayment(models.Model):
@@ -124,12 +124,40 @@ import logging
 
 _logger = logging.getLogger(__name__)
 
+# Rates claimed per batch when the cron is not run through remote.sync.channel
+RATE_BATCH_SIZE = 100
+
 class ResCurrencyRate(models.Model):
     _inherit = 'res.currency.rate'
 
     posted_to_remote = fields.Boolean("Posted to Remote", default=False)
     failed_to_sync = fields.Boolean("Failed to Sync", default=False)
 
+    def init(self):
+        super().init()
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS res_currency_rate_remote_sync_pending_idx
+            ON res_currency_rate (currency_id, id)
+            WHERE (posted_to_remote IS NULL OR posted_to_remote = false)
+              AND (failed_to_sync IS NULL OR failed_to_sync = false)
+        """)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        rates = super(ResCurrencyRate, self).create(vals_list)
+        self.env['remote.sync.job'].sudo()._enqueue_eligible(rates, 'currency_rate')
+        return rates
+
+    @api.model
+    def _get_remote_currency_domain(self):
+        """ Return the domain leaf of the rates sent to the remote: the
+        currencies of ``remote_operations.sync_rate_currencies``, or the $ ones. """
+        codes = self.env['ir.config_parameter'].sudo().get_param('remote_operations.sync_rate_currencies')
+        codes = [code.strip().upper() for code in (codes or '').split(',') if code.strip()]
+        if codes:
+            return ('currency_id.name', 'in', codes)
+        return ('currency_id.symbol', '=', '$')
+
     @api.model
     def send_currency_rate_to_remote(self):
         """Send unsynchronized currency rates to the remote server."""
@@ -151,39 +179,107 @@ class ResCurrencyRate(models.Model):
 
         try:
             # Authenticate with the remote server
-            common = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/common', allow_none=True)
-            uid = common.authenticate(db, username, password, {})
-            models = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/object', allow_none=True)
-
-            # Find unsynchronized currency rates for the $ symbol
-            currency_rates = self.search([
-                ('posted_to_remote', '=', False),
-                ('failed_to_sync', '=', False),
-                ('currency_id.symbol', '=', '$'),
-            ], limit=10)
-
-            for rate in currency_rates:
-                try:
-                    # Prepare data for synchronization
-                    currency_rate_data = rate._prepare_rate_data(models, db, uid, password)
-                    _logger.info("Preparing rate data for synchronization: %s", currency_rate_data)
-
-                    # Send data to the remote server
-                    new_rate_id = models.execute_kw(db, uid, password, 'res.currency.rate', 'create', [currency_rate_data])
-                    rate.write({'posted_to_remote': True})
-                    _logger.info("Currency rate successfully synchronized. Remote ID: %s", new_rate_id)
-
-                except Exception as sync_error:
-                    rate.write({'failed_to_sync': True})
-                    _logger.error("Failed to synchronize rate ID %s: %s", rate.id, str(sync_error))
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
+
+            # Consume the unsynchronized currency rates of the synced currencies queued for the remote
+            job_obj = self.env['remote.sync.job'].sudo()
+            jobs = job_obj._claim_jobs('currency_rate', limit=RATE_BATCH_SIZE)
+            with jobs._fail_on_error():
+                currency_rates = jobs._get_records('res.currency.rate').filtered_domain(
+                    job_obj._get_channel_domains()['currency_rate'][1])
+                if currency_rates:
+                    currency_rates._send_rates_to_remote_bulk(models, db, uid, password)
+
+                jobs.filtered(lambda j: j.state == 'running')._set_done()
 
         except Exception as connection_error:
             raise ValidationError(_("Error connecting to remote server: %s") % connection_error)
 
+    def _send_rates_to_remote_bulk(self, models, db, uid, password):
+        """Send the rates of ``self`` with one create for the batch.
+
+        Rates landing on the same remote currency, company and day are collapsed
+        to the last one written, and the rates the remote already has for that
+        day are updated instead of created. Rates a bulk call is rejected for are
+        sent one by one, so that a single invalid rate does not fail the others;
+        rates a bulk call got no answer for are retried later as a unit, once
+        ``existing`` tells which of them the remote created.
+        """
+        job_obj = self.env['remote.sync.job'].sudo()
+        id_map = self.env['remote.id.map']
+        id_map._prefetch(models, 'res.company', self.company_id)
+        id_map._prefetch(models, 'res.currency', self.currency_id)
+
+        latest = {}
+        superseded = self.browse()
+        for rate in self.sorted(lambda r: (r.write_date, r.id)):
+            try:
+                rate_data = rate._prepare_rate_data(models, db, uid, password)
+            except Exception as prepare_error:
+                if not job_obj._record_failed(rate, prepare_error, actions=['create']):
+                    rate.write({'failed_to_sync': True})
+                _logger.error("Failed to prepare rate ID %s: %s", rate.id, str(prepare_error))
+                continue
+            key = (rate_data['currency_id'], rate_data['company_id'], rate_data['name'])
+            if key in latest:
+                superseded |= latest[key][0]
+            latest[key] = (rate, rate_data)
+        if superseded:
+            superseded.write({'posted_to_remote': True})
+            _logger.info("Skipped %s currency rates superseded by a later one of the same day.", len(superseded))
+        if not latest:
+            return
+
+        existing = {}
+        for remote_rate in models.execute_kw(
+                db, uid, password, 'res.currency.rate', 'search_read',
+                [[('currency_id', 'in', list(set(key[0] for key in latest))),
+                  ('name', 'in', list(set(key[2] for key in latest)))]],
+                {'fields': ['id', 'currency_id', 'company_id', 'name']}):
+            key = (remote_rate['currency_id'] and remote_rate['currency_id'][0],
+                   remote_rate['company_id'] and remote_rate['company_id'][0] or None, remote_rate['name'])
+            existing[key] = remote_rate['id']
+
+        to_create = [(rate, rate_data) for key, (rate, rate_data) in latest.items() if key not in existing]
+        retry = [(rate, rate_data) for key, (rate, rate_data) in latest.items() if key in existing]
+        if to_create:
+            try:
+                models.execute_kw(db, uid, password, 'res.currency.rate', 'create',
+                                  [[rate_data for rate, rate_data in to_create]])
+            except xmlrpc.client.Fault as e:
+                _logger.warning("Bulk creation of %s currency rates failed, sending them one by one: %s",
+                                len(to_create), str(e))
+                retry = to_create + retry
+            except Exception as e:
+                # The remote may have created the rates: retry them as a unit, the
+                # next attempt finds them in ``existing`` and updates them instead
+                _logger.warning("Bulk creation of %s currency rates got no answer, retrying them later: %s",
+                                len(to_create), str(e))
+                for rate, rate_data in to_create:
+                    if not job_obj._record_failed(rate, e, actions=['create']):
+                        rate.write({'failed_to_sync': True})
+            else:
+                self.browse([rate.id for rate, rate_data in to_create]).write({'posted_to_remote': True})
+                _logger.info("Created %s currency rates on remote.", len(to_create))
+
+        for rate, rate_data in retry:
+            key = (rate_data['currency_id'], rate_data['company_id'], rate_data['name'])
+            try:
+                if key in existing:
+                    models.execute_kw(db, uid, password, 'res.currency.rate', 'write', [[existing[key]], rate_data])
+                else:
+                    models.execute_kw(db, uid, password, 'res.currency.rate', 'create', [rate_data])
+                rate.write({'posted_to_remote': True})
+            except Exception as sync_error:
+                if not job_obj._record_failed(rate, sync_error, actions=['create']):
+                    rate.write({'failed_to_sync': True})
+                _logger.error("Failed to synchronize rate ID %s: %s", rate.id, str(sync_error))
+
     def _prepare_rate_data(self, models, db, uid, password):
         """Prepare currency rate data for the remote server."""
         return {
-            'name': self.name,
+            'name': fields.Date.to_string(self.name),
             'company_id': self._map_to_remote_company(models, db, uid, password, self.company_id),
             'rate': self.rate,
             'currency_id': self._get_remote_currency_id(models, db, uid, password, self.currency_id),
@@ -196,14 +292,20 @@ class ResCurrencyRate(models.Model):
         if not company_id:
             raise ValidationError(_("Company is required for mapping."))
 
-        return self._get_remote_id(models, db, uid, password, 'res.company', 'name', company_id.name)
+        return self.env['remote.id.map']._resolve(
+            models, company_id,
+            lambda: self._get_remote_id(models, db, uid, password, 'res.company', 'name', company_id.name)
+        )
 
     def _get_remote_currency_id(self, models, db, uid, password, currency_id):
         """Map the local currency to the corresponding remote currency."""
         if not currency_id:
             raise ValidationError(_("Currency is required for mapping."))
 
-        return self._get_remote_id(models, db, uid, password, 'res.currency', 'name', currency_id.name)
+        return self.env['remote.id.map']._resolve(
+            models, currency_id,
+            lambda: self._get_remote_id(models, db, uid, password, 'res.currency', 'name', currency_id.name)
+        )
 
     def _get_remote_id(self, models, db, uid, password, model, field_name, field_value):
         """Retrieve the remote record ID by searching for a matching field value."""
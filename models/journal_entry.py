@@ -4,10 +4,12 @@ from odoo import models, fields, api, _
 import requests, json, base64
 from datetime import datetime, date
 from odoo.exceptions import ValidationError, UserError
+from odoo.tools import float_compare
 import xmlrpc.client
 from pytz import timezone
 import logging
 from symbol import lambdef
+from .remote_connection import RemoteUnavailableError
 
 _logger = logging.getLogger(__name__)
 
@@ -20,8 +22,24 @@ class AccountMove(models.Model):
     posted_to_remote = fields.Boolean("Posted to remote", copy=False)
     failed_to_sync = fields.Boolean("Failed to Sync", default=False)
     remote_move_id = fields.Integer(string="Remote Move", copy=False)
+    remote_payload_hash = fields.Char(string="Remote Payload Hash", copy=False, readonly=True)
+    remote_sync_in_doubt = fields.Boolean("Remote Creation In Doubt", copy=False, readonly=True,
+                                          help="The last create call got no answer: the remote move may exist.")
     no_allow_sync = fields.Boolean("Not Allow Sync")
 
+    def init(self):
+        super().init()
+        # Moves still to send are a tiny part of the table: index only them, in the
+        # form the ORM writes the boolean = False conditions, so the planner uses it
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_move_remote_sync_pending_idx
+            ON account_move (move_type, date, id)
+            WHERE state = 'posted'
+              AND (posted_to_remote IS NULL OR posted_to_remote = false)
+              AND (failed_to_sync IS NULL OR failed_to_sync = false)
+              AND (no_allow_sync IS NULL OR no_allow_sync = false)
+        """)
+
     
     def action_sync_to_remote_manual(self):
         """ Manually sync selected account moves to a remote Odoo server """
@@ -40,13 +58,13 @@ class AccountMove(models.Model):
             raise UserError(_("Remote server settings must be fully configured (URL, DB, Username, Password)"))
 
         try:
-            common = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/common', allow_none=True)
-            uid = common.authenticate(db, username, password, {})
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
             if not uid:
                 raise UserError(_("Authentication failed with remote server."))
 
-            models = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/object', allow_none=True)
-            start_date = fields.Date.to_date('2024-07-01')
+            start_date = self.env['remote.sync.watermark']._get_start_date()
+            self._prefetch_remote_master_data(models, db, uid, password, self)
 
             for move in self:
                 try:
@@ -117,53 +135,226 @@ class AccountMove(models.Model):
 
         # Create XML-RPC connection and send data
         try:
-            common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(url), allow_none=True)
-            uid = common.authenticate(db, username, password, {})
-            models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(url), allow_none=True)
-
-            start_date = date(2024,7,1).isoformat()
-            # account_moves = self.search([('posted_to_remote', '=', False),('move_type', '=', 'entry')], limit=10)
-            account_moves = self.sudo().search([('posted_to_remote', '=', False), \
-                                                ('state', '=', 'posted'), ('move_type', '=', 'entry'), ('journal_id.type', '=', 'general') ,('failed_to_sync', '=', False),('date', '>=', start_date),('no_allow_sync','=', False)], limit=10,
-                                               order='date asc')
-           
-        
-            for move in account_moves:
-                try: 
-                    if move.journal_id.dont_synchronize:
-                        continue
-                    # Ensure partner exists in remote database
-                    for line in move.line_ids:
-                        if line.partner_id:
-                            remote_partner_id = self._get_remote_id_if_set(models, db, uid, password, 'res.partner', 'name', line.partner_id)
-                            if not remote_partner_id and line.partner_id:
-                                remote_partner_id = self._create_remote_partner(models, db, uid, password, line.partner_id)
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
+
+            # Consume the journal entries queued for creation on the remote
+            job_obj = self.env['remote.sync.job'].sudo()
+            jobs = job_obj._claim_jobs('journal_entry', limit=10)
+            with jobs._fail_on_error():
+                account_moves = jobs._get_records('account.move').sudo().filtered_domain(
+                    job_obj._get_channel_domains()['journal_entry'][1]).sorted('date')
+                self._prefetch_remote_master_data(models, db, uid, password, account_moves)
+
+                moves_data = []
+                for move in account_moves:
+                    try: 
+                        if move.journal_id.dont_synchronize:
+                            continue
+                        # Ensure partner exists in remote database
+                        for line in move.line_ids:
+                            if line.partner_id:
+                                remote_partner_id = self._get_remote_id_if_set(models, db, uid, password, 'res.partner', 'name', line.partner_id)
+                                if not remote_partner_id and line.partner_id:
+                                    remote_partner_id = self._create_remote_partner(models, db, uid, password, line.partner_id)
                             
 
-                    # company_id = self._get_remote_id(models, db, uid, password, 'res.company', 'name',
-                    #                                  move.journal_id.company_id.name)
-                    move_data = self._prepare_move_data(models, db, uid, password, move, move.company_id.id)
-                    _logger.info("Account Move Data: %s", str(move_data))
-                    new_move = models.execute_kw(db, uid, password, 'account.move', 'create', [move_data])
-                    _logger.info("New Account Move: %s", str(new_move))
-                    move.write({'posted_to_remote': True})
-                    move.remote_move_id = new_move
-                    # Post the new move
-                    models.execute_kw(db, uid, password, 'account.move', 'action_post', [[new_move]])
-                    _logger.info("Posted Account Move: %s", str(new_move))
-                    self.env.cr.commit()
-                    # self.write({'posted_to_remote': True})
+                        # company_id = self._get_remote_id(models, db, uid, password, 'res.company', 'name',
+                        #                                  move.journal_id.company_id.name)
+                        move_data = self._prepare_move_data(models, db, uid, password, move, move.company_id.id)
+                        _logger.info("Account Move Data: %s", str(move_data))
+                        moves_data.append((move, move_data))
                     
-                except Exception as e:
-                    move.write({'failed_to_sync': True})  # Mark record as failed to prevent retries
-                    _logger.error("Error processing Account Move inside ID %s: %s", move.id, str(e))
-                    move.message_post(body="Error processing Move ID {}: {}".format(move.id, str(e)))
+                    except Exception as e:
+                        self._mark_remote_sync_failed(move, e)
 
-                    # self.env.cr.rollback()
+                # Create and post the whole batch at once
+                self._send_moves_batch_to_remote(models, db, uid, password, moves_data)
+                # Jobs not flagged as failed are either synced or no longer need to be
+                jobs.filtered(lambda j: j.state == 'running')._set_done()
 
         except Exception as e:
             raise ValidationError("Error while sending account move data to remote server: {}".format(e))
 
+    def _send_moves_batch_to_remote(self, models, db, uid, password, moves_data):
+        """
+        Create the remote moves of ``moves_data`` (a list of (move, vals)) with a
+        single create call and post them with a single action_post call.
+
+        If the remote rejects the batch (a Fault, the transaction was rolled
+        back), fall back to one call per move so that only the faulty moves are
+        flagged as failed. If the call got no answer, the remote may have created
+        the moves: they are flagged as in doubt and retried as a unit, and the
+        next attempt adopts the remote moves it finds instead of creating them again.
+        """
+        moves_data, adopted = self._adopt_remote_moves(models, db, uid, password, moves_data)
+        if adopted:
+            self.env.cr.commit()
+            self._post_remote_moves(models, db, uid, password, adopted)
+        if not moves_data:
+            return
+
+        in_flight = self.browse([move.id for move, move_data in moves_data])
+        in_flight.write({'remote_sync_in_doubt': True})
+        self.env.cr.commit()
+        try:
+            new_moves = models.execute_kw(db, uid, password, 'account.move', 'create',
+                                          [[move_data for move, move_data in moves_data]])
+        except xmlrpc.client.Fault as e:
+            _logger.warning("Batch creation of %s remote moves failed, sending them one by one: %s", len(moves_data), str(e))
+            in_flight.write({'remote_sync_in_doubt': False})
+            for move, move_data in moves_data:
+                try:
+                    new_move = models.execute_kw(db, uid, password, 'account.move', 'create', [move_data])
+                except Exception as move_error:
+                    self._mark_remote_sync_failed(move, move_error, in_doubt=not isinstance(move_error, xmlrpc.client.Fault))
+                    continue
+                move.write({'posted_to_remote': True, 'remote_move_id': new_move, 'remote_sync_in_doubt': False,
+                            'remote_payload_hash': self.env['remote.connection']._payload_hash(move_data)})
+                self.env.cr.commit()
+                self._post_remote_moves(models, db, uid, password, move)
+            return
+        except Exception as e:
+            _logger.warning("Batch creation of %s remote moves got no answer, retrying them as a unit: %s", len(moves_data), str(e))
+            for move in in_flight:
+                self._mark_remote_sync_failed(move, e, in_doubt=True)
+            return
+
+        moves = self.browse()
+        for (move, move_data), new_move in zip(moves_data, new_moves):
+            move.write({'posted_to_remote': True, 'remote_move_id': new_move, 'remote_sync_in_doubt': False,
+                        'remote_payload_hash': self.env['remote.connection']._payload_hash(move_data)})
+            moves |= move
+        _logger.info("Created %s remote moves: %s", len(new_moves), new_moves)
+        # Keep track of the remote ids even if posting fails afterwards
+        self.env.cr.commit()
+        self._post_remote_moves(models, db, uid, password, moves)
+
+    def _adopt_remote_moves(self, models, db, uid, password, moves_data):
+        """
+        Look on the remote for the moves of ``moves_data`` whose last create call
+        got no answer, matching them on journal, date, reference, type and total.
+        The matches that no other move is mapped to are adopted instead of being
+        created again.
+
+        Return the (move, vals) still to create and the adopted moves.
+        """
+        in_doubt = [(move, move_data) for move, move_data in moves_data if move.remote_sync_in_doubt]
+        if not in_doubt:
+            return moves_data, self.browse()
+
+        def match_key(journal_id, move_date, ref, move_type, amount_total):
+            return journal_id, str(move_date), ref or False, move_type, round(amount_total, 2)
+
+        candidates = models.execute_kw(db, uid, password, 'account.move', 'search_read', [[
+            ('journal_id', 'in', list({move_data['journal_id'] for move, move_data in in_doubt})),
+            ('date', 'in', list({fields.Date.to_string(move.date) for move, move_data in in_doubt})),
+            ('create_uid', '=', uid),
+        ]], {'fields': ['journal_id', 'date', 'ref', 'move_type', 'amount_total']})
+        mapped = set(self.sudo().search([
+            ('remote_move_id', 'in', [candidate['id'] for candidate in candidates]),
+        ]).mapped('remote_move_id'))
+        available = {}
+        for candidate in candidates:
+            if candidate['id'] not in mapped:
+                available.setdefault(match_key(
+                    candidate['journal_id'][0], candidate['date'], candidate['ref'],
+                    candidate['move_type'], candidate['amount_total'],
+                ), []).append(candidate['id'])
+
+        remaining, adopted = [], self.browse()
+        for move, move_data in moves_data:
+            matches = move.remote_sync_in_doubt and available.get(match_key(
+                move_data['journal_id'], move.date, move.ref, move.move_type, move.amount_total))
+            if not matches:
+                remaining.append((move, move_data))
+                continue
+            move.write({'posted_to_remote': True, 'remote_move_id': matches.pop(0), 'remote_sync_in_doubt': False,
+                        'remote_payload_hash': self.env['remote.connection']._payload_hash(move_data)})
+            _logger.info("Adopted remote move %s for Move ID %s", move.remote_move_id, move.id)
+            adopted |= move
+        return remaining, adopted
+
+    def _post_remote_moves(self, models, db, uid, password, moves):
+        """
+        Post the remote counterparts of ``moves`` with one action_post call,
+        falling back to one call per move when the batch is rejected.
+        """
+        try:
+            models.execute_kw(db, uid, password, 'account.move', 'action_post', [moves.mapped('remote_move_id')])
+            _logger.info("Posted remote moves: %s", moves.mapped('remote_move_id'))
+            return
+        except Exception as e:
+            if len(moves) == 1:
+                self._mark_remote_post_failed(moves, e)
+                return
+            _logger.warning("Batch posting of %s remote moves failed, posting them one by one: %s", len(moves), str(e))
+
+        for move in moves:
+            try:
+                models.execute_kw(db, uid, password, 'account.move', 'action_post', [[move.remote_move_id]])
+                _logger.info("Posted remote move: %s", move.remote_move_id)
+            except Exception as move_error:
+                self._mark_remote_post_failed(move, move_error)
+
+    def _mark_remote_post_failed(self, move, error):
+        """ The remote move of ``move`` exists but is still draft: queue a post job
+        so that only action_post is retried; unless a retry was scheduled, flag
+        the move as failed. """
+        job = self.env['remote.sync.job'].sudo()._enqueue(move, 'journal_entry' if move.move_type == 'entry' else 'invoice', 'post')
+        job._set_failed(error)
+        if job.state == 'pending':
+            return
+        move.write({'failed_to_sync': True})
+        _logger.error("Error posting remote move %s of Move ID %s: %s", move.remote_move_id, move.id, str(error))
+        move.message_post(body="Error posting remote move {} of Move ID {}: {}".format(move.remote_move_id, move.id, str(error)))
+
+    def _mark_remote_sync_failed(self, move, error, in_doubt=None):
+        """ Record the failure on the creation job of ``move``; unless a retry was
+        scheduled, flag the move as failed so that the crons leave it alone.
+
+        When given, ``in_doubt`` tells whether the create call may have reached
+        the remote; an error raised before the call was sent rules it out. """
+        if in_doubt is not None:
+            move.write({'remote_sync_in_doubt': in_doubt and not isinstance(error, RemoteUnavailableError)})
+        if self.env['remote.sync.job'].sudo()._record_failed(move, error, actions=['create']):
+            return
+        move.write({'failed_to_sync': True})
+        _logger.error("Error processing Move ID %s: %s", move.id, str(error))
+        move.message_post(body="Error processing Move ID {}: {}".format(move.id, str(error)))
+
+    def _prefetch_remote_master_data(self, models, db, uid, password, moves, products=False):
+        """
+        Resolve every company, journal, account, tax, analytic account, currency
+        and partner referenced by ``moves`` with one remote search_read per model
+        (and company), so that preparing the payloads reads from the id map.
+        The products are only resolved with ``products``: the journal entry
+        payloads do not send them, the invoice ones do.
+        """
+        id_map = self.env['remote.id.map']
+        lines = moves.line_ids
+
+        id_map._prefetch(models, 'res.company', moves.mapped(lambda m: m.branch_id or m.company_id))
+        id_map._prefetch(models, 'res.currency', moves.currency_id | lines.currency_id)
+        id_map._prefetch(models, 'res.partner', moves.partner_id | lines.partner_id)
+        if products:
+            id_map._prefetch(models, 'product.product', lines.product_id)
+
+        for company in moves.journal_id.company_id:
+            id_map._prefetch(models, 'account.journal', moves.journal_id.filtered(lambda j: j.company_id == company),
+                             domain=[('company_id', '=', company.id)])
+
+        for company in moves.company_id:
+            company_lines = lines.filtered(lambda l: l.move_id.company_id == company)
+            company_domain = ['|', ('company_id', '=', company.id), ('company_id', '=', False), ('active', '=', True)]
+            id_map._prefetch(models, 'account.account',
+                             company_lines.mapped(lambda l: l.account_id.substitute_account or l.account_id),
+                             domain=[('company_ids', 'in', [company.id])], company_id=company.id)
+            id_map._prefetch(models, 'account.tax', company_lines.tax_ids,
+                             domain=company_domain, company_id=company.id)
+            id_map._prefetch(models, 'account.analytic.account', company_lines.analytic_account_id,
+                             domain=company_domain, company_id=company.id)
+
     def _prepare_move_data(self, models, db, uid, password, move, company_id):
         move_lines = []
         for line in move.line_ids:
@@ -176,7 +367,8 @@ class AccountMove(models.Model):
             # account_id = self._map_account_to_remote_company(models, db, uid, password, company_id, account_code)
 
             account_id = self._map_account_name_to_remote_company(models, db, uid, password, company_id,
-                                                                      account_name_to_check)
+                                                                      account_name_to_check,
+                                                                      account=line.account_id.substitute_account or line.account_id)
 
             currency_id = self._get_remote_id_if_set(models, db, uid, password, 'res.currency', 'name', line.currency_id)
             
@@ -237,9 +429,10 @@ class AccountMove(models.Model):
             ]
 
             # Map the local analytic account to the remote analytic account by name and company
-            remote_analytic_account_id = models.execute_kw(
-                db, uid, password, 'account.analytic.account', 'search',
-                [domain])[0]
+            remote_analytic_account_id = self.env['remote.id.map']._resolve(
+                models, local_analytic_account,
+                lambda: models.execute_kw(db, uid, password, 'account.analytic.account', 'search', [domain])[0],
+                company_id=company_id)
 
             return remote_analytic_account_id
 
@@ -272,9 +465,9 @@ class AccountMove(models.Model):
             raise ValueError("Either branch_id or company_id must be provided to map to a remote company.")
 
         # Map to the remote company by name or another unique field
-        remote_company_id = self._get_remote_id(
-            models, db, uid, password,
-            'res.company', 'name', local_company.name
+        remote_company_id = self.env['remote.id.map']._resolve(
+            models, local_company,
+            lambda: self._get_remote_id(models, db, uid, password, 'res.company', 'name', local_company.name)
         )
 
         return remote_company_id
@@ -298,13 +491,16 @@ class AccountMove(models.Model):
             local_company_id = local_journal.company_id.id
         
             # Map to the remote company journal by name and company
-            remote_journal_id = self._get_remote_journal_id(
-                models, db, uid, password,
-                'account.journal', 
-                domain=[
-                    ('name', '=', local_journal.name),
-                    ('company_id', '=', local_company_id)
-                ]
+            remote_journal_id = self.env['remote.id.map']._resolve(
+                models, local_journal,
+                lambda: self._get_remote_journal_id(
+                    models, db, uid, password,
+                    'account.journal',
+                    domain=[
+                        ('name', '=', local_journal.name),
+                        ('company_id', '=', local_company_id)
+                    ]
+                )
             )
 
         return remote_journal_id
@@ -352,6 +548,7 @@ class AccountMove(models.Model):
             print(f"remote_model[0]>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>{remote_model}")
         else:
             raise ValueError("Domain is required to search for remote records.")
+        return remote_model[0] if remote_model else None
     
     def _map_account_to_remote_company(self, models, db, uid, password, company_id, account_code):
         """
@@ -376,10 +573,19 @@ class AccountMove(models.Model):
         print(f"Mapped Account Code {account_code} to Remote Account ID {remote_account_id}")
         return remote_account_id
 
-    def _map_account_name_to_remote_company(self, models, db, uid, password, company_id, account_codename):
+    def _map_account_name_to_remote_company(self, models, db, uid, password, company_id, account_codename, account=None):
         """
         Maps the account name to the remote company's account.
+
+        When the local ``account`` is given, the result is stored in and read
+        from the remote.id.map table instead of searching the remote each time.
         """
+        if account:
+            return self.env['remote.id.map']._resolve(
+                models, account,
+                lambda: self._map_account_name_to_remote_company(models, db, uid, password, company_id, account_codename),
+                company_id=company_id)
+
         _logger.info(f"Account name to search {account_codename}")
         if not account_codename:
             raise ValueError("Account name is required to map the remote account.")
@@ -445,7 +651,10 @@ class AccountMove(models.Model):
 
     def _get_remote_id_if_set(self, models, db, uid, password, model, field_name, field):
         if field:
-            return self._get_remote_id(models, db, uid, password, model, field_name, field.name)
+            return self.env['remote.id.map']._resolve(
+                models, field,
+                lambda: self._get_remote_id(models, db, uid, password, model, field_name, field.name)
+            )
         return False
 
     def _create_remote_partner(self, models, db, uid, password, partner):
@@ -479,7 +688,9 @@ class AccountMove(models.Model):
                 'property_account_payable_id': property_account_payable_id,
             }
             _logger.info(f"\n\n\n---------------------------------------------------\nPARTNER {partner_data} \n\n\n")
-            return models.execute_kw(db, uid, password, 'res.partner', 'create', [partner_data])
+            remote_partner_id = models.execute_kw(db, uid, password, 'res.partner', 'create', [partner_data])
+            self.env['remote.id.map']._store(models, partner, remote_partner_id)
+            return remote_partner_id
             # return partner_data
 
     @api.model
@@ -503,49 +714,39 @@ class AccountMove(models.Model):
         
         try:
             # Create XML-RPC connection
-            common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(url), allow_none=True)
-            uid = common.authenticate(db, username, password, {})
-            models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(url), allow_none=True)
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
             
-            start_date = date(2024, 7, 1).isoformat()
-            account_moves = self.sudo().search([
-                ('posted_to_remote', '=', False), 
-                ('state', '=', 'posted'),
-                ('move_type', '!=', 'entry'),
-                ('failed_to_sync', '=', False),
-                ('date', '>=', start_date),
-                ('no_allow_sync','=', False)
-            ], limit=10, order='date asc')
+            # Consume the invoices queued for creation on the remote
+            job_obj = self.env['remote.sync.job'].sudo()
+            jobs = job_obj._claim_jobs('invoice', limit=10)
+            with jobs._fail_on_error():
+                account_moves = jobs._get_records('account.move').sudo().filtered_domain(
+                    job_obj._get_channel_domains()['invoice'][1]).sorted('date')
             
-            _logger.info(f"Account Moves to Process: {account_moves.read(['name', 'posted_to_remote'])}")
+                _logger.info(f"Account Moves to Process: {account_moves.read(['name', 'posted_to_remote'])}")
+                self._prefetch_remote_master_data(models, db, uid, password, account_moves, products=True)
             
-            for move in account_moves:
-                try:
-                    # Skip moves linked to journals marked as "don't synchronize"
-                    if move.journal_id.dont_synchronize:
-                        continue
-                    
-                    # Prepare and send data to the remote server
-                    company_id = self._get_remote_id(models, db, uid, password, 'res.company', 'name', move.journal_id.company_id.name)
-                    _logger.info(f"Processing Move: {move.read(['name', 'company_id', 'partner_id'])}")
+                moves_data = []
+                for move in account_moves:
+                    try:
+                        # Skip moves linked to journals marked as "don't synchronize"
+                        if move.journal_id.dont_synchronize:
+                            continue
                     
-                    move_data = self._prepare_invoice_data(models, db, uid, password, move, move.company_id.id)
-                    _logger.info("Prepared Move Data: %s", str(move_data))
+                        # Prepare data to send to the remote server
+                        _logger.info(f"Processing Move: {move.read(['name', 'company_id', 'partner_id'])}")
                     
-                    new_move = models.execute_kw(db, uid, password, 'account.move', 'create', [move_data])
-                    _logger.info("Created Remote Move: %s", str(new_move))
-                    move.write({'posted_to_remote': True, 'remote_move_id': new_move})
-                    # Post the move remotely
-                    models.execute_kw(db, uid, password, 'account.move', 'action_post', [[new_move]])
-                    _logger.info("Posted Remote Move: %s", str(new_move))
-                    # Mark move as posted to remote
-                    # move.write({'posted_to_remote': True, 'remote_move_id': new_move})
-                except Exception as inner_e:
-                    # Log and mark move as failed
-                    move.write({'failed_to_sync': True})
-                    _logger.error("Error Processing Move ID %s: %s", move.id, str(inner_e))
-                    move.message_post(body="Error processing Move ID {}: {}".format(move.id, str(inner_e)))
-
+                        move_data = self._prepare_invoice_data(models, db, uid, password, move, move.company_id.id)
+                        _logger.info("Prepared Move Data: %s", str(move_data))
+                        moves_data.append((move, move_data))
+                    except Exception as inner_e:
+                        # Log and mark move as failed
+                        self._mark_remote_sync_failed(move, inner_e)
+
+                # Create and post the whole batch remotely
+                self._send_moves_batch_to_remote(models, db, uid, password, moves_data)
+                jobs.filtered(lambda j: j.state == 'running')._set_done()
             
             # Log summary of the process
             successful_moves = account_moves.filtered(lambda m: m.posted_to_remote)
@@ -653,10 +854,16 @@ class AccountMove(models.Model):
         #     #             reconciled_result = move.sudo().js_assign_outstanding_line(rec1.id)
         #     #             _logger.info("Reconciled payment line %s with invoice %s", rec1.id, move.id)
 
-    def _get_remote_tax_id(self, models, db, uid, password, model, field_name, field_value, company_id):
+    def _get_remote_tax_id(self, models, db, uid, password, model, field_name, field_value, company_id, tax=None):
         """
         Fetches the remote tax ID based on the field value and company ID.
         """
+        if tax:
+            return self.env['remote.id.map']._resolve(
+                models, tax,
+                lambda: self._get_remote_tax_id(models, db, uid, password, model, field_name, field_value, company_id),
+                company_id=company_id)
+
         domain = [
             (field_name, '=', field_value), 
             '|',  
@@ -731,13 +938,14 @@ class AccountMove(models.Model):
 
             if account_name_to_check:
                 account_id = self._map_account_name_to_remote_company(models, db, uid, password, company_id,
-                                                                      account_name_to_check)
+                                                                      account_name_to_check,
+                                                                      account=account.substitute_account or account)
                 remote_analytic_account_id = self._prepare_analytic_distribution(models, db, uid, password,
                                                                                  line.analytic_account_id, company_id)
                 tax_ids = [
                     self._get_remote_tax_id(
                         models, db, uid, password,
-                        'account.tax', 'name', tax.name, move.company_id.id
+                        'account.tax', 'name', tax.name, move.company_id.id, tax=tax
                     )
                     for tax in line.tax_ids
                 ]
@@ -830,24 +1038,71 @@ class AccountMove(models.Model):
     #     return remote_account_id
     def button_cancel(self):
         result = super(AccountMove, self).button_cancel()
-        for move in self:
-            move._reset_cancel_remote_record()
+        self._enqueue_remote_sync_jobs('cancel')
         return result
     
     def button_draft(self):
         result = super(AccountMove, self).button_draft()
-        for move in self:
-            move._reset_remote_record()
+        self._enqueue_remote_sync_jobs('reset')
         return result
     
-    def action_post(self):
-        super().action_post()
-        for move in self:
-            if move.move_type == 'entry':
-                move._update_remote_record()
-            else: 
-                move._update_invoice_remote_record()
+    def _post(self, soft=True):
+        # Every posting goes through here (button, autopost, reconciliation, POS closing)
+        posted = super()._post(soft)
+        job_obj = self.env['remote.sync.job'].sudo()
+        # New moves wait for the crons, the ones already on the remote are updated
+        job_obj._enqueue_eligible(posted.filtered(lambda m: not m.remote_move_id and m.move_type == 'entry'), 'journal_entry')
+        job_obj._enqueue_eligible(posted.filtered(lambda m: not m.remote_move_id and m.move_type != 'entry'), 'invoice')
+        posted._enqueue_remote_sync_jobs('update')
+        return posted
+
+    def _enqueue_remote_sync_jobs(self, action):
+        """ Enqueue ``action`` for the moves that already exist on the remote;
+        the deferred job runner propagates it outside of the user request. """
+        job_obj = self.env['remote.sync.job'].sudo()
+        jobs = job_obj.browse()
+        for move in self.filtered('remote_move_id'):
+            channel = 'journal_entry' if move.move_type == 'entry' else 'invoice'
+            jobs |= job_obj._enqueue(move, channel, action)
+        if jobs:
+            job_obj._trigger_deferred_runner()
+        return jobs
+
+    def _run_remote_sync_job(self, action):
+        """ Propagate ``action`` (post, update, reset or cancel) to the remote move. """
+        self.ensure_one()
+        if action == 'post':
+            self._post_remote_record()
+        elif action == 'update':
+            if self.move_type == 'entry':
+                self._update_remote_record()
+            else:
+                self._update_invoice_remote_record()
+        elif action == 'reset':
+            self._reset_remote_record()
+        elif action == 'cancel':
+            self._reset_cancel_remote_record()
     
+    def _post_remote_record(self):
+        """ Post the remote move created without being posted, unless it already is. """
+        self.ensure_one()
+        if not self.remote_move_id:
+            return
+
+        config_parameters = self.env['ir.config_parameter'].sudo()
+        url = config_parameters.get_param('remote_operations.url')
+        db = config_parameters.get_param('remote_operations.db')
+        username = config_parameters.get_param('remote_operations.username')
+        password = config_parameters.get_param('remote_operations.password')
+
+        models = self.env['remote.connection']._get_client(url, db, username, password)
+        uid = models.uid
+        remote_move = models.execute_kw(db, uid, password, 'account.move', 'read',
+                                        [[self.remote_move_id]], {'fields': ['state']})
+        if remote_move and remote_move[0]['state'] == 'draft':
+            models.execute_kw(db, uid, password, 'account.move', 'action_post', [[self.remote_move_id]])
+            _logger.info("Posted remote move: %s", self.remote_move_id)
+
     def _reset_cancel_remote_record(self):
         """Reset the corresponding record in the remote Odoo 18 database."""
         self.ensure_one()
@@ -866,9 +1121,8 @@ class AccountMove(models.Model):
 
         try:
             # Connect to the remote Odoo database
-            common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(url), allow_none=True)
-            uid = common.authenticate(db, username, password, {})
-            models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(url), allow_none=True)
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
 
             # Reset the state of the remote record to draft
             _logger.info("Resetting remote record ID %s to cancel.", self.remote_move_id)
@@ -882,6 +1136,7 @@ class AccountMove(models.Model):
 
         except Exception as e:
             _logger.error("Error resetting remote record ID %s to cancel: %s", self.remote_move_id, str(e))
+            raise
         
 
 
@@ -903,9 +1158,8 @@ class AccountMove(models.Model):
 
         try:
             # Connect to the remote Odoo database
-            common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(url), allow_none=True)
-            uid = common.authenticate(db, username, password, {})
-            models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(url), allow_none=True)
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
 
             # Reset the state of the remote record to draft
             _logger.info("Resetting remote record ID %s to draft.", self.remote_move_id)
@@ -919,6 +1173,7 @@ class AccountMove(models.Model):
 
         except Exception as e:
             _logger.error("Error resetting remote record ID %s to draft: %s", self.remote_move_id, str(e))
+            raise
             
       
     
@@ -941,36 +1196,28 @@ class AccountMove(models.Model):
 
         try:
             # Connect to the remote Odoo database
-            common = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/common', allow_none=True)
-            uid = common.authenticate(db, username, password, {})
-            models = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/object', allow_none=True)
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
 
-            # Step 1: Delete existing line_ids in the remote record
-            remote_line_ids = models.execute_kw(
-                db, uid, password, 
-                'account.move.line', 
-                'search', 
-                [[('move_id', '=', self.remote_move_id)]]
-            )
-            if remote_line_ids:
+            update_data = self._prepare_remote_update_data(models, db, uid, password, self, self.company_id.id)
+            payload_hash = self.env['remote.connection']._payload_hash(update_data)
+
+            if payload_hash == self.remote_payload_hash:
+                _logger.info("Remote record ID %s is up to date, skipping the update.", self.remote_move_id)
+            else:
+                # Only send the lines that changed instead of recreating all of them
+                update_data['line_ids'] = self._diff_remote_lines(
+                    models, db, uid, password, [('move_id', '=', self.remote_move_id)], update_data['line_ids'])
+                _logger.info("Updating remote record ID %s with data: %s", self.remote_move_id, update_data)
+                # Update the record in the remote database
                 models.execute_kw(
-                    db, uid, password, 
-                    'account.move.line', 
-                    'unlink', 
-                    [remote_line_ids]
+                    db, uid, password,
+                    'account.move',
+                    'write',
+                    [[self.remote_move_id], update_data]
                 )
-                _logger.info("Successfully deleted remote line_ids for remote record ID %s.", self.remote_move_id)
-
-            update_data = self._prepare_remote_update_data(models, db, uid, password, self, self.company_id.id)
-            _logger.info("Updating remote record ID %s with data: %s", self.remote_move_id, update_data)
-            # Step 3: Update the record in the remote database
-            models.execute_kw(
-                db, uid, password, 
-                'account.move', 
-                'write', 
-                [[self.remote_move_id], update_data]
-            )
-            _logger.info("Successfully updated remote record ID %s.", self.remote_move_id)
+                self.write({'remote_payload_hash': payload_hash})
+                _logger.info("Successfully updated remote record ID %s.", self.remote_move_id)
             
             # Post the updated move
             models.execute_kw(db, uid, password, 'account.move', 'action_post', [[self.remote_move_id]])
@@ -978,49 +1225,86 @@ class AccountMove(models.Model):
         except Exception as e:
             _logger.error("Error updating remote record ID %s: %s", self.remote_move_id, str(e))
             self.message_post(body="Error processing Move ID {}: {}".format( self.remote_move_id, str(e)))
+            raise
 
             
             
     def _prepare_remote_update_data(self, models, db, uid, password, move, company_id):
-        move_lines = []
-        for line in move.line_ids:
-            account_to_check = line.account_id.code
-            if line.account_id.substitute_account:
-                account_to_check = line.account_id.substitute_account.code
-    
-            account_id = self._map_account_to_remote_company(models, db, uid, password, company_id, account_to_check)
+        # Same payload as the creation, the accounts are mapped by name like there
+        return self._prepare_move_data(models, db, uid, password, move, company_id)
 
-            currency_id = self._get_remote_id_if_set(models, db, uid, password, 'res.currency', 'name', line.currency_id)
-            
-            remote_analytic_account_id = self._prepare_analytic_distribution(models, db, uid, password, \
-                                                                             line.analytic_account_id, company_id)
+    def _diff_remote_lines(self, models, db, uid, password, remote_domain, line_commands, optional_fields=()):
+        """ Turn the ``(0, 0, vals)`` commands of the local lines into the
+        commands that bring the remote lines matching ``remote_domain`` in line
+        with them: identical lines are left alone, the others are updated with
+        their changed fields only, and extra lines are created or deleted.
 
-            move_line_data = {
-                'account_id': account_id,
-                'name': line.name,
-                'debit': line.debit,
-                'credit': line.credit,
-                'partner_id': self._get_remote_id_if_set(models, db, uid, password, 'res.partner', 'name', line.partner_id) or None,
-                'currency_id': currency_id,
-                'amount_currency': line.amount_currency,
-                'analytic_distribution': {str(remote_analytic_account_id): 100} if remote_analytic_account_id else {} or None,
-            }
+        ``optional_fields`` are left to the remote when the local value is empty
+        (e.g. the label of invoice lines computed from the product).
+        """
+        local_lines = [vals for command, _id, vals in line_commands]
+        field_names = sorted({name for vals in local_lines for name in vals})
+        remote_lines = models.execute_kw(
+            db, uid, password, 'account.move.line', 'search_read',
+            [remote_domain], {'fields': field_names, 'order': 'sequence, id'}
+        )
+        for remote_line in remote_lines:
+            for name in field_names:
+                remote_line[name] = self._normalize_line_value(name, remote_line.get(name))
+
+        def changed_values(vals, remote_line):
+            changes = {}
+            for name, value in vals.items():
+                local_value = self._normalize_line_value(name, value)
+                if name in optional_fields and not local_value:
+                    continue
+                if not self._line_values_equal(local_value, remote_line[name]):
+                    changes[name] = [(6, 0, local_value)] if name == 'tax_ids' else value
+            return changes
+
+        # Keep the remote lines that are already identical to a local one
+        unmatched_remote = list(remote_lines)
+        unmatched_local = []
+        for vals in local_lines:
+            same = next((line for line in unmatched_remote if not changed_values(vals, line)), None)
+            if same:
+                unmatched_remote.remove(same)
+            else:
+                unmatched_local.append(vals)
+
+        # Update the remaining ones in order, then create or delete the surplus
+        commands = []
+        for vals, remote_line in zip(unmatched_local, unmatched_remote):
+            commands.append((1, remote_line['id'], changed_values(vals, remote_line)))
+        commands += [(0, 0, vals) for vals in unmatched_local[len(unmatched_remote):]]
+        commands += [(2, line['id']) for line in unmatched_remote[len(unmatched_local):]]
+        _logger.info("Remote lines diff: %s unchanged, %s updated, %s created, %s deleted.",
+                     len(local_lines) - len(unmatched_local), min(len(unmatched_local), len(unmatched_remote)),
+                     max(len(unmatched_local) - len(unmatched_remote), 0),
+                     max(len(unmatched_remote) - len(unmatched_local), 0))
+        return commands
+
+    @api.model
+    def _normalize_line_value(self, name, value):
+        """ Bring a line value read from the remote or built for it to a comparable form. """
+        if name == 'tax_ids':
+            # Local values are link commands, remote ones plain ids
+            return sorted(item[1] if isinstance(item, (list, tuple)) else item for item in value or [])
+        if name == 'analytic_distribution':
+            return {str(key): float(percent) for key, percent in (value or {}).items()}
+        if isinstance(value, (list, tuple)) and len(value) == 2 and isinstance(value[0], int):
+            return value[0]  # many2one read as (id, display name)
+        return value or False
+
+    @api.model
+    def _line_values_equal(self, local_value, remote_value):
+        if isinstance(local_value, float) or isinstance(remote_value, float):
+            return float_compare(local_value or 0.0, remote_value or 0.0, precision_digits=6) == 0
+        if isinstance(local_value, dict):
+            return local_value.keys() == (remote_value or {}).keys() and all(
+                float_compare(percent, remote_value[key], precision_digits=6) == 0 for key, percent in local_value.items())
+        return local_value == remote_value
 
-            move_lines.append((0, 0, move_line_data))
-            
-        move_data = {
-            'patient': move.patient_id.name or None,
-            'company_id': self._map_branch_to_remote_company(models, db, uid, password, move.branch_id, move.company_id) or None,
-            'ref': move.ref or None,
-            'date': move.date or None,
-            'move_type': move.move_type or None,
-            'currency_id': currency_id or None,
-            'journal_id': self._map_journal_to_remote_company(models, db, uid, password, move.journal_id) or None,
-            'line_ids': move_lines,
-        }
-        
-        return move_data
-    
     
 
 
@@ -1043,44 +1327,43 @@ class AccountMove(models.Model):
 
         try:
             # Connect to the remote Odoo database
-            common = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/common', allow_none=True)
-            uid = common.authenticate(db, username, password, {})
-            models = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/object', allow_none=True)
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
 
-            # Step 1: Fetch the account.move record to get invoice_line_ids
+            # Step 1: Check the account.move record still exists
             remote_move = models.execute_kw(
                 db, uid, password,
                 'account.move',
-                'search_read',
+                'search',
                 [[('id', '=', self.remote_move_id)]],  # Searching for the specific move_id
-                {'fields': ['invoice_line_ids']}  # Only fetch invoice_line_ids field
             )
 
             if remote_move:
-                remote_invoice_line_ids = remote_move[0].get('invoice_line_ids', [])
-                _logger.info("Fetched remote invoice_line_ids for remote record ID %s: %s", self.remote_move_id, remote_invoice_line_ids)
+                # Step 2: Prepare the updated data for the invoice
+                update_data = self._prepare_invoice_data(models, db, uid, password, self, self.company_id.id)
+                payload_hash = self.env['remote.connection']._payload_hash(update_data)
+
+                if payload_hash == self.remote_payload_hash:
+                    _logger.info("Remote record ID %s is up to date, skipping the update.", self.remote_move_id)
+                else:
+                    # Step 3: Only send the invoice lines that changed, the remote
+                    # recomputes the tax and payment term lines from them
+                    update_data['invoice_line_ids'] = self._diff_remote_lines(
+                        models, db, uid, password,
+                        [('move_id', '=', self.remote_move_id),
+                         ('display_type', 'in', ('product', 'line_section', 'line_note'))],
+                        update_data['invoice_line_ids'], optional_fields=('name',))
+                    _logger.info("Updating remote record ID %s with data: %s", self.remote_move_id, update_data)
 
-                # Step 2: If invoice_line_ids exist, unlink them
-                if remote_invoice_line_ids:
+                    # Step 4: Update the record in the remote database
                     models.execute_kw(
                         db, uid, password,
-                        'account.move.line',
-                        'unlink',
-                        [remote_invoice_line_ids]  # Unlink the invoice lines
+                        'account.move',
+                        'write',
+                        [[self.remote_move_id], update_data]
                     )
-                    _logger.info("Successfully unlinked remote invoice_line_ids for remote record ID %s.", self.remote_move_id)
-
-                # Step 3: Prepare the updated data for the invoice
-                update_data = self._prepare_invoice_data(models, db, uid, password, self, self.company_id.id)
-                _logger.info("Updating remote record ID %s with data: %s", self.remote_move_id, update_data)
-
-                # Step 4: Update the record in the remote database
-                models.execute_kw(
-                    db, uid, password,
-                    'account.move',
-                    'write',
-                    [[self.remote_move_id], update_data]
-                )
+                    self.write({'remote_payload_hash': payload_hash})
+                # Post it again, the reset left it in draft
                 models.execute_kw(db, uid, password, 'account.move', 'action_post', [[self.remote_move_id]])
 
                 _logger.info("Successfully updated remote record ID %s.", self.remote_move_id)
@@ -1092,6 +1375,7 @@ class AccountMove(models.Model):
         except Exception as e:
             _logger.error("Error updating remote record ID %s: %s", self.remote_move_id, str(e))
             self.message_post(body="Error processing Move ID {}: {}".format(self.remote_move_id, str(e)))
+            raise
 
 
                 
@@ -35,6 +35,24 @@ class ResConfigSettings(models.TransientModel):
     password = fields.Char(string='Password', config_parameter='remote_operations.password')
     model = fields.Char(string='Remote Model', config_parameter='remote_operations.model')
     record_id = fields.Char(string='Default Partner Id', config_parameter='remote_operations.record_id')
+    sync_workers = fields.Integer(string='Sync Workers', config_parameter='remote_operations.sync_workers', default=1,
+                                  help="Number of parallel workers pushing moves and payments to the remote.")
+    sync_time_budget = fields.Integer(string='Sync Time Budget', config_parameter='remote_operations.sync_time_budget', default=60,
+                                      help="Seconds each sync cron keeps sending batches before it stops until its next run.")
+    sync_deadline = fields.Integer(string='Sync Deadline', config_parameter='remote_operations.sync_deadline', default=100,
+                                   help="Seconds after which a sync cron run refuses to start remote calls. "
+                                        "Keep it below the time limit of the cron workers.")
+    rpc_connect_timeout = fields.Integer(string='Remote Connect Timeout', config_parameter='remote_operations.rpc_connect_timeout',
+                                         default=10, help="Seconds to wait for the connection to the remote server.")
+    rpc_read_timeout = fields.Integer(string='Remote Read Timeout', config_parameter='remote_operations.rpc_read_timeout',
+                                      default=60, help="Seconds to wait for the answer of a remote call.")
+    sync_rate_currencies = fields.Char(string='Synced Rate Currencies', config_parameter='remote_operations.sync_rate_currencies',
+                                       help="Comma-separated codes of the currencies whose rates are sent to the remote, "
+                                            "e.g. USD,EUR. When empty, the rates of the $ currencies are sent.")
+    rpc_rate_limit = fields.Float(string='Remote Calls per Second', config_parameter='remote_operations.rpc_rate_limit',
+                                  default=10, help="Calls per second each worker process may send to the remote server, 0 for no limit.")
+    rpc_max_concurrency = fields.Integer(string='Concurrent Remote Calls', config_parameter='remote_operations.rpc_max_concurrency',
+                                         default=4, help="Transactions that may call the remote server at the same time, 0 for no limit.")
 
     def db_connection_action(self):
         return {
@@ -1,84 +1,126 @@
 # -*- coding: utf-8 -*-
 
 from odoo import models, fields, api, _
+from collections import defaultdict
 import requests, json, base64
 from datetime import datetime, date
 from odoo.exceptions import ValidationError, UserError
+from odoo.tools.sql import column_exists
 import xmlrpc.client
 from pytz import timezone
 import logging
 _logger = logging.getLogger(__name__)
 
+class AccountMove(models.Model):
+    _inherit = 'account.move'
+
+    remote_consolidated_move_id = fields.Integer(
+        string="Remote Consolidated Move", copy=False, readonly=True,
+        help="Remote move summarizing this POS move with the others of its session and journal.")
+
+
 class PosSession(models.Model):
     _inherit = 'pos.session'
 
     posted_to_remote = fields.Boolean("Posted to remote")
+    stock_posted_to_remote = fields.Boolean("Stock Posted to remote", copy=False)
+
+    def _auto_init(self):
+        backfill = not column_exists(self.env.cr, 'pos_session', 'stock_posted_to_remote')
+        result = super()._auto_init()
+        if backfill:
+            # The stock of the sessions closed before the flag existed was pushed on close
+            self.env.cr.execute("UPDATE pos_session SET stock_posted_to_remote = true WHERE state = 'closed'")
+        return result
+
+    def _register_hook(self):
+        super()._register_hook()
+        # The stock push cron has nothing to do unless this model is loaded
+        cron = self.env.ref('remote_operations.ir_cron_remote_sync_pos_stock', raise_if_not_found=False)
+        if cron and not cron.active:
+            cron.active = True
 
     def action_pos_session_closing_control(self, balancing_account=False, amount_to_balance=0, bank_payment_method_diffs=None):
         super(PosSession, self).action_pos_session_closing_control(balancing_account, amount_to_balance, bank_payment_method_diffs)
         self.send_account_moves_to_remote()
-        self._create_custom_stock_quant_in_remote()
+        # Push the stock movements from a cron, the cashier does not wait for them
+        self.env['remote.sync.job'].sudo()._enqueue(self.filtered(lambda s: not s.stock_posted_to_remote), 'pos_stock')
+        cron = self.env.ref('remote_operations.ir_cron_remote_sync_pos_stock', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+
+    @api.model
+    def send_stock_to_remote(self):
+        """ Consume the closed sessions queued for their stock push, one
+        transaction per session; failed pushes are retried with a backoff. """
+        job_obj = self.env['remote.sync.job'].sudo()
+        jobs = job_obj._claim_jobs('pos_stock', limit=5)
+        with jobs._fail_on_error():
+            for session in jobs._get_records('pos.session').filtered(lambda s: not s.stock_posted_to_remote):
+                try:
+                    session._create_custom_stock_quant_in_remote()
+                    session.stock_posted_to_remote = True
+                except Exception as e:
+                    _logger.error("Error sending stock of POS session %s to remote: %s", session.name, str(e))
+                    session.message_post(body="Error sending stock to remote: {}".format(e))
+                    job_obj._record_failed(session, e)
+                self.env.cr.commit()
+            jobs.filtered(lambda j: j.state == 'running')._set_done()
 
     def _create_custom_stock_quant_in_remote(self):
         # Check if the database is configured as "Branch Database"
         config_parameters = self.env['ir.config_parameter'].sudo()
-        remote_type = config_parameters.get_param('stacafe_remote_operations.remote_type')
+        remote_type = config_parameters.get_param('remote_operations.remote_type')
 
         if remote_type == 'Branch Database':
 
-            url = config_parameters.get_param('stacafe_remote_operations.url')
-            db = config_parameters.get_param('stacafe_remote_operations.db')
-            username = config_parameters.get_param('stacafe_remote_operations.username')
-            password = config_parameters.get_param('stacafe_remote_operations.password')
+            url = config_parameters.get_param('remote_operations.url')
+            db = config_parameters.get_param('remote_operations.db')
+            username = config_parameters.get_param('remote_operations.username')
+            password = config_parameters.get_param('remote_operations.password')
 
             if not all([url, db, username, password]):
                 raise ValidationError("Remote server settings must be fully configured (URL, DB, Username, Password)")
 
             try:
                 # Create XML-RPC connection to the remote database
-                common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(url))
-                uid = common.authenticate(db, username, password, {})
+                models = self.env['remote.connection']._get_client(url, db, username, password)
+                uid = models.uid
                 if not uid:
                     raise ValidationError("Failed to authenticate with the remote server.")
-                
-                models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(url))
 
                 # Fetch all pickings associated with this POS session
                 pickings = self.env['stock.picking'].search([('pos_session_id', '=', self.id)])
 
-                # Create custom.stock.quant records in the remote database
-                for picking in pickings:
-                    for move in picking.move_ids_without_package:
-
-                         # Fetch the standard_price from the remote database using product name
-                        product_data = models.execute_kw(db, uid, password, 'product.product', 'search_read', [
-                            [('name', '=', move.product_id.name)]
-                        ], {'fields': ['id','standard_price'], 'limit': 1})
-                        
-                        if not product_data:
-                            raise ValidationError(f"Product {move.product_id.name} not found in the remote database.")
-
-                        remote_product_id = product_data[0]['id']
-                        remote_standard_price = product_data[0]['standard_price']
-                        product_uom = self._get_remote_id(models, db, uid, password, 'uom.uom', 'name', move.product_uom.name)
-
-
-                        # Fetch remote location IDs
-                        remote_location_id = self._get_remote_id(models, db, uid, password, 'stock.location', 'name', move.location_id.name)
-                        remote_location_dest_id = self._get_remote_id(models, db, uid, password, 'stock.location', 'name', move.location_dest_id.name)
-
-                        custom_quant_vals = {
-                            'product_id': int(remote_product_id),
-                            'product_uom_id': product_uom,
-                            'date': date.today(),
-                            'quantity': -move.product_uom_qty,  # Quantity should be negative since it's a sale
-                            'unit_price': remote_standard_price,  # Use the standard price or another logic
-                            'location_id': remote_location_id,
-                            'destination_id': remote_location_dest_id,
-                        }
-
-                        # Create the custom.stock.quant in the remote database
-                        models.execute_kw(db, uid, password, 'custom.stock.quant', 'create', [custom_quant_vals])
+                # One row per product, unit and locations
+                quantities = defaultdict(float)
+                for move in pickings.move_ids_without_package:
+                    quantities[(move.product_id, move.product_uom, move.location_id, move.location_dest_id)] += move.product_uom_qty
+                if not quantities:
+                    return
+
+                # Fetch the standard_price from the remote database using product name
+                products = self._search_remote_by_name(
+                    models, db, uid, password, 'product.product', [key[0].name for key in quantities], ['standard_price'])
+                uoms = self._search_remote_by_name(models, db, uid, password, 'uom.uom', [key[1].name for key in quantities])
+                locations = self._search_remote_by_name(
+                    models, db, uid, password, 'stock.location', [name for key in quantities for name in (key[2].name, key[3].name)])
+
+                today = fields.Date.to_string(fields.Date.context_today(self))
+                custom_quant_vals = [{
+                    'product_id': products[product.name]['id'],
+                    'product_uom_id': uoms[product_uom.name]['id'],
+                    'date': today,
+                    'quantity': -quantity,  # Quantity should be negative since it's a sale
+                    'unit_price': products[product.name]['standard_price'],  # Use the standard price or another logic
+                    'location_id': locations[location.name]['id'],
+                    'destination_id': locations[location_dest.name]['id'],
+                } for (product, product_uom, location, location_dest), quantity in quantities.items()]
+
+                # Create the custom.stock.quant records in the remote database
+                models.execute_kw(db, uid, password, 'custom.stock.quant', 'create', [custom_quant_vals])
+                _logger.info("Created %s custom stock quants for %s moves of POS session %s.",
+                             len(custom_quant_vals), len(pickings.move_ids_without_package), self.name)
 
             except Exception as e:
                 raise ValidationError("Error while creating custom stock quant in remote database: {}".format(e))
@@ -87,15 +129,15 @@ class PosSession(models.Model):
         # Get configuration parameters
         config_parameters = self.env['ir.config_parameter'].sudo()
 
-        remote_type = config_parameters.get_param('stacafe_remote_operations.remote_type')
+        remote_type = config_parameters.get_param('remote_operations.remote_type')
         if remote_type != 'Branch Database':
             _logger.info("Database is not configured as 'Branch Database'. Skipping sending account moves to remote.")
             return
         
-        url = config_parameters.get_param('stacafe_remote_operations.url')
-        db = config_parameters.get_param('stacafe_remote_operations.db')
-        username = config_parameters.get_param('stacafe_remote_operations.username')
-        password = config_parameters.get_param('stacafe_remote_operations.password')
+        url = config_parameters.get_param('remote_operations.url')
+        db = config_parameters.get_param('remote_operations.db')
+        username = config_parameters.get_param('remote_operations.username')
+        password = config_parameters.get_param('remote_operations.password')
 
         # Validate settings
         if not all([url, db, username, password]):
@@ -103,15 +145,17 @@ class PosSession(models.Model):
 
         # Create XML-RPC connection and send data
         try:
-            common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(url))
-            uid = common.authenticate(db, username, password, {})
-            models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(url))
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
 
             # Get related account.move records
-            account_moves = self._get_related_account_moves()
+            account_moves = self._get_related_account_moves().filtered(lambda m: not m.journal_id.dont_synchronize)
+            if config_parameters.get_param('remote_operations.pos_consolidate_moves'):
+                # Invoices of the session keep their own remote move
+                entries = account_moves.filtered(lambda m: m.move_type == 'entry')
+                self._send_consolidated_moves_to_remote(models, db, uid, password, entries)
+                account_moves -= entries
             for move in account_moves:
-                if move.journal_id.dont_synchronize:
-                    continue
                 company_id = self._get_remote_id(models, db, uid, password, 'res.company', 'name', move.journal_id.company_id.name)
                 move_data = self._prepare_move_data(models, db, uid, password, move, company_id)
                 _logger.info("Account Move Data: %s", str(move_data))
@@ -127,6 +171,65 @@ class PosSession(models.Model):
         except Exception as e:
             raise ValidationError("Error while sending account move data to remote server: {}".format(e))
 
+    def _send_consolidated_moves_to_remote(self, models, db, uid, password, account_moves):
+        """ Send one summarized move per journal instead of the moves of the
+        session, and keep the remote move on the source moves for drill-down. """
+        for journal in account_moves.journal_id:
+            moves = account_moves.filtered(lambda m: m.journal_id == journal)
+            company_id = self._get_remote_id(models, db, uid, password, 'res.company', 'name', journal.company_id.name)
+            move_data = self._prepare_consolidated_move_data(models, db, uid, password, journal, moves, company_id)
+            _logger.info("Consolidated Account Move Data: %s", str(move_data))
+            new_move = models.execute_kw(db, uid, password, 'account.move', 'create', [move_data])
+            models.execute_kw(db, uid, password, 'account.move', 'action_post', [[new_move]])
+            moves.write({'remote_consolidated_move_id': new_move})
+            _logger.info("Posted Consolidated Account Move %s for %s moves of %s.", new_move, len(moves), journal.name)
+
+    def _prepare_consolidated_move_data(self, models, db, uid, password, journal, moves, company_id):
+        """ Merge the lines of ``moves`` per account, partner and currency into
+        one line carrying their net balance and amount in currency; the keys
+        that net to zero are left out. """
+        totals = defaultdict(lambda: {'balance': 0.0, 'amount_currency': 0.0})
+        for line in moves.line_ids:
+            total = totals[(line.account_id.substitute_account or line.account_id, line.partner_id, line.currency_id)]
+            total['balance'] += line.balance
+            total['amount_currency'] += line.amount_currency
+
+        # The same accounts, partners and currencies come back on many keys
+        remote_ids = {}
+
+        def remote_id(model, field_name, record):
+            if (model, record) not in remote_ids:
+                remote_ids[(model, record)] = self._get_remote_id(
+                    models, db, uid, password, model, field_name, record[field_name]) if record else False
+            return remote_ids[(model, record)]
+
+        company_currency = journal.company_id.currency_id
+        move_lines = []
+        for (account, partner, currency), total in totals.items():
+            balance = company_currency.round(total['balance'])
+            amount_currency = (currency or company_currency).round(total['amount_currency'])
+            if company_currency.is_zero(balance) and (currency or company_currency).is_zero(amount_currency):
+                continue
+            move_lines.append((0, 0, {
+                'account_id': remote_id('account.account', 'code', account),
+                'name': f"{self.name} - {account.name}",
+                'debit': max(balance, 0.0),
+                'credit': max(-balance, 0.0),
+                'partner_id': remote_id('res.partner', 'name', partner),
+                'currency_id': remote_id('res.currency', 'name', currency),
+                'amount_currency': amount_currency,
+            }))
+
+        return {
+            'company_id': company_id,
+            'ref': f"{self.name} - {journal.name}",
+            'date': fields.Date.to_string(max(moves.mapped('date'))),
+            'move_type': 'entry',
+            'currency_id': remote_id('res.currency', 'name', journal.currency_id or company_currency),
+            'journal_id': self._get_remote_id(models, db, uid, password, 'account.journal', 'name', journal.name),
+            'line_ids': move_lines,
+        }
+
     def _prepare_move_data(self, models, db, uid, password, move, company_id):
         move_lines = []
         for line in move.line_ids:
@@ -189,6 +292,20 @@ class PosSession(models.Model):
             raise ValidationError(_("The record for model '%s' with %s '%s' cannot be found in the remote database.") % (model, field_name, field_value))
         return remote_record[0]['id']
 
+    def _search_remote_by_name(self, models, db, uid, password, model, names, field_names=()):
+        """ Return ``{name: {'id': ..., *fields}}`` of the first remote ``model``
+        record of each of ``names``, with one search_read. """
+        names = list(set(names))
+        remote_records = {}
+        for remote_record in models.execute_kw(db, uid, password, model, 'search_read', [[('name', 'in', names)]],
+                                               {'fields': ['id', 'name'] + list(field_names)}):
+            remote_records.setdefault(remote_record['name'], remote_record)
+        missing = [name for name in names if name not in remote_records]
+        if missing:
+            raise ValidationError(_("The records for model '%s' with name %s cannot be found in the remote database.")
+                                  % (model, ', '.join(missing)))
+        return remote_records
+
     def _get_remote_id_if_set(self, models, db, uid, password, model, field_name, field):
         if field:
             return self._get_remote_id(models, db, uid, password, model, field_name, field.name)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api, SUPERUSER_ID, _
+from .remote_connection import RemoteUnavailableError, make_transport
+from datetime import timedelta
+import xmlrpc.client
+import logging
+_logger = logging.getLogger(__name__)
+
+# Consecutive connection failures that open the breaker
+FAILURE_THRESHOLD = 3
+# How long an open breaker rejects calls, doubled each time the trial call fails
+OPEN_SECONDS = 60
+MAX_OPEN_SECONDS = 15 * 60
+# How long the caller that got the half-open trial has to report its outcome,
+# after which another caller (or the probe cron) gets a new trial
+TRIAL_LEASE_SECONDS = 180
+
+
+class RemoteCircuitBreaker(models.Model):
+    """ Connection health of a remote database, shared by all the workers.
+
+    After FAILURE_THRESHOLD connection failures in a row the breaker opens and
+    every sync call to the remote fails fast with RemoteUnavailableError. Once
+    ``retry_at`` is reached, a single caller (or the probe cron) gets through
+    as a half-open trial: success closes the breaker, failure opens it again
+    for twice as long. The trial is leased until ``retry_at``, so a caller that
+    never reports back (no call made, deadline reached) does not keep the
+    breaker half-open forever.
+
+    The state is written in its own transaction, so that it is kept when the
+    failing sync rolls back.
+    """
+    _name = 'remote.circuit.breaker'
+    _description = 'Remote Circuit Breaker'
+    _rec_name = 'remote_key'
+
+    remote_key = fields.Char(string='Remote Database', required=True, readonly=True)
+    state = fields.Selection([
+        ('closed', 'Closed'),
+        ('open', 'Open'),
+        ('half_open', 'Half-Open'),
+    ], string='State', required=True, default='closed', readonly=True)
+    failure_count = fields.Integer(string='Consecutive Failures', readonly=True)
+    open_seconds = fields.Integer(string='Open Duration (s)', default=OPEN_SECONDS, readonly=True)
+    retry_at = fields.Datetime(string='Retry At', readonly=True)
+    last_error = fields.Text(string='Last Error', readonly=True)
+
+    _sql_constraints = [
+        ('remote_key_uniq', 'unique(remote_key)', 'A remote database can only have one circuit breaker.'),
+    ]
+
+    @api.model
+    def _is_open(self, remote_key):
+        """ Tell whether calls to ``remote_key`` are currently rejected, without
+        claiming the trial call of an expired breaker. """
+        self.env.cr.execute("""
+            SELECT 1 FROM remote_circuit_breaker
+            WHERE remote_key = %s
+              AND state IN ('open', 'half_open') AND retry_at > now() at time zone 'UTC'
+        """, (remote_key,))
+        return bool(self.env.cr.fetchone())
+
+    @api.model
+    def _check(self, remote_key):
+        """ Return the breaker state the caller may proceed in ('closed' or
+        'half_open' for the trial call), or raise RemoteUnavailableError. """
+        self.env.cr.execute("SELECT state, retry_at FROM remote_circuit_breaker WHERE remote_key = %s", (remote_key,))
+        row = self.env.cr.fetchone()
+        if not row or row[0] == 'closed':
+            return 'closed'
+        state, retry_at = row
+        if not retry_at or retry_at <= fields.Datetime.now():
+            # Only one worker wins the trial call, until its lease expires
+            with self.pool.cursor() as cr:
+                cr.execute("""
+                    UPDATE remote_circuit_breaker
+                    SET state = 'half_open', retry_at = now() at time zone 'UTC' + make_interval(secs => %s),
+                        write_date = now() at time zone 'UTC'
+                    WHERE remote_key = %s AND state IN ('open', 'half_open')
+                      AND (retry_at IS NULL OR retry_at <= now() at time zone 'UTC')
+                    RETURNING id
+                """, (TRIAL_LEASE_SECONDS, remote_key))
+                if cr.fetchone():
+                    return 'half_open'
+        raise RemoteUnavailableError(
+            _("The remote server %s is unreachable, calls are suspended until %s.") % (remote_key, retry_at))
+
+    @api.model
+    def _record_failure(self, remote_key, error):
+        """ Count a connection failure; open the breaker at the threshold or when
+        the half-open trial failed. """
+        with self.pool.cursor() as cr:
+            cr.execute("""
+                INSERT INTO remote_circuit_breaker (remote_key, state, failure_count, open_seconds, last_error,
+                                                    create_uid, create_date, write_uid, write_date)
+                VALUES (%s, 'closed', 1, %s, %s, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+                ON CONFLICT (remote_key) DO UPDATE
+                SET failure_count = remote_circuit_breaker.failure_count + 1, last_error = EXCLUDED.last_error,
+                    write_date = EXCLUDED.write_date
+                RETURNING state, failure_count, open_seconds
+            """, (remote_key, OPEN_SECONDS, str(error), SUPERUSER_ID, SUPERUSER_ID))
+            state, failure_count, open_seconds = cr.fetchone()
+            if state == 'half_open':
+                open_seconds = min(open_seconds * 2, MAX_OPEN_SECONDS)
+            elif state == 'open' or failure_count < FAILURE_THRESHOLD:
+                return
+            cr.execute("""
+                UPDATE remote_circuit_breaker
+                SET state = 'open', open_seconds = %s, retry_at = now() at time zone 'UTC' + make_interval(secs => %s)
+                WHERE remote_key = %s
+            """, (open_seconds, open_seconds, remote_key))
+        _logger.warning("Circuit breaker of remote %s opened for %ss after %s failures: %s",
+                        remote_key, open_seconds, failure_count, str(error))
+
+    @api.model
+    def _record_success(self, remote_key):
+        with self.pool.cursor() as cr:
+            cr.execute("""
+                UPDATE remote_circuit_breaker
+                SET state = 'closed', failure_count = 0, open_seconds = %s, retry_at = NULL,
+                    write_date = now() at time zone 'UTC'
+                WHERE remote_key = %s AND (state != 'closed' OR failure_count > 0)
+                RETURNING id
+            """, (OPEN_SECONDS, remote_key))
+            if cr.fetchone():
+                _logger.info("Circuit breaker of remote %s closed.", remote_key)
+
+    @api.model
+    def _probe(self):
+        """ Cron: try the breakers due for a trial, or whose trial lease expired,
+        with a cheap unauthenticated ``version()`` call, so the sync resumes
+        without waiting for a sync call. """
+        for breaker in self.sudo().search([
+            ('state', 'in', ('open', 'half_open')), ('retry_at', '<=', fields.Datetime.now()),
+        ]):
+            try:
+                self._check(breaker.remote_key)
+            except RemoteUnavailableError:
+                continue  # Another worker is already trying
+            url = breaker.remote_key.rsplit('|', 1)[0]
+            try:
+                xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/common', transport=make_transport(url)).version()
+            except Exception as e:
+                self._record_failure(breaker.remote_key, e)
+                continue
+            self._record_success(breaker.remote_key)
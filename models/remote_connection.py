@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, api, _
+from odoo.exceptions import UserError
+import contextlib
+import hashlib
+import http.client
+import json
+import threading
+import time
+import xmlrpc.client
+import logging
+_logger = logging.getLogger(__name__)
+
+# Odoo maps AccessDenied to this XML-RPC fault code
+RPC_FAULT_CODE_ACCESS_DENIED = 3
+
+# Default timeouts of a remote call, see remote_operations.rpc_*_timeout
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+# Calls are not started with less time than this left before the deadline of the run
+MIN_CALL_SECONDS = 2
+
+# One pool per thread: ServerProxy objects are not thread safe, but reusing
+# them inside a worker keeps the underlying HTTP connection alive.
+_pool = threading.local()
+
+
+class RemoteUnavailableError(UserError):
+    """ The circuit breaker of the remote is open or its rate limit is reached,
+    the call was not attempted. """
+
+
+class RemoteDeadlineError(RemoteUnavailableError):
+    """ The sync run is too close to its deadline, the call was not attempted. """
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """ Refuse the remote calls of the current thread that cannot finish
+    within ``seconds``, and shorten the timeouts of the others to fit. """
+    previous = getattr(_pool, 'deadline', None)
+    _pool.deadline = time.monotonic() + seconds
+    if previous is not None:
+        _pool.deadline = min(previous, _pool.deadline)
+    try:
+        yield
+    finally:
+        _pool.deadline = previous
+
+
+class TimeoutTransport(xmlrpc.client.Transport):
+    """ Transport with a connect and a read timeout, which keeps the HTTP
+    keep-alive connection between calls like the default one. """
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, **kwargs):
+        super().__init__(**kwargs)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        # Used when http.client (re)opens the socket
+        connection.timeout = self.connect_timeout
+        if connection.sock is None:
+            connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection
+
+
+class SafeTimeoutTransport(TimeoutTransport, xmlrpc.client.SafeTransport):
+    pass
+
+
+def make_transport(url, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+    transport_class = SafeTimeoutTransport if url.startswith('https') else TimeoutTransport
+    return transport_class(connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+
+def is_connection_error(error):
+    """ Tell whether ``error`` means the remote could not be reached or is
+    overloaded, as opposed to the remote rejecting the call itself. """
+    if isinstance(error, xmlrpc.client.ProtocolError):
+        return error.errcode == 429 or error.errcode >= 500
+    return isinstance(error, (OSError, http.client.HTTPException))
+
+
+class RemoteClient(object):
+    """ XML-RPC client bound to one remote (url, db, username).
+
+    The ``common`` and ``object`` proxies live as long as the worker and share
+    one transport, so the HTTP keep-alive connection is reused between calls,
+    and the uid is only authenticated once and refreshed when the remote
+    rejects it. Every call gets the connect and read timeouts of the client,
+    shortened to the deadline of the current run if any.
+
+    ``execute_kw`` keeps the ``ServerProxy`` signature, so a client can be
+    passed as ``models`` to the existing sync helpers unchanged.
+    """
+
+    def __init__(self, url, db, username, password):
+        self.url = url
+        self.db = db
+        self.username = username
+        self.password = password
+        self.connect_timeout = CONNECT_TIMEOUT
+        self.read_timeout = READ_TIMEOUT
+        self.transport = make_transport(url)
+        self.common = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/common', transport=self.transport, allow_none=True)
+        self.object = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/object', transport=self.transport, allow_none=True)
+        self._uid = False
+        # Committed remote.id.map entries already read or resolved by this
+        # worker, keyed by local database, model, id and company
+        self.id_cache = {}
+        # remote.circuit.breaker of the current caller, set by _get_client
+        self.breaker = None
+        # 'closed' once a call succeeded and the breaker was told about it
+        self.breaker_state = 'closed'
+        # remote.rate.limit of the current caller, set by _get_client
+        self.limiter = None
+        # Endpoints the remote turned out not to have, e.g. an older version of this module
+        self.missing_methods = set()
+
+    @property
+    def key(self):
+        return (self.url, self.db, self.username)
+
+    @property
+    def remote_key(self):
+        """ Identify the remote database, regardless of the user. """
+        return f'{self.url}|{self.db}'
+
+    @property
+    def uid(self):
+        if not self._uid:
+            self.authenticate()
+        return self._uid
+
+    def authenticate(self):
+        uid = self._guarded(self.common.authenticate, self.db, self.username, self.password, {})
+        if not uid:
+            raise UserError(_("Authentication failed with remote server."))
+        self._uid = uid
+        _logger.info("Authenticated on remote %s (db %s) as uid %s", self.url, self.db, uid)
+        return uid
+
+    def execute_kw(self, db, uid, password, model, method, args, kwargs=None):
+        """ Same signature as ``ServerProxy.execute_kw``; the db, uid and
+        password of the client are used, and the call is replayed once after
+        re-authenticating if the remote session was rejected. """
+        try:
+            return self._execute_kw(model, method, args, kwargs)
+        except xmlrpc.client.Fault as fault:
+            if fault.faultCode != RPC_FAULT_CODE_ACCESS_DENIED:
+                raise
+            _logger.info("Remote %s rejected uid %s, re-authenticating.", self.url, self._uid)
+            self._uid = False
+            return self._execute_kw(model, method, args, kwargs)
+
+    def _execute_kw(self, model, method, args, kwargs=None):
+        return self._guarded(self.object.execute_kw, self.db, self.uid, self.password, model, method, args, kwargs or {})
+
+    def _guarded(self, call, *args):
+        """ Run ``call`` once the rate limiter lets it through, within the
+        timeouts and deadline, and report connection failures and recoveries
+        to the circuit breaker of the remote. """
+        if self.limiter is not None:
+            self.limiter._acquire(self.remote_key, self._time_left())
+        try:
+            read_timeout = self._time_left()
+            self.transport.connect_timeout = min(self.connect_timeout, read_timeout)
+            self.transport.read_timeout = read_timeout
+            result = call(*args)
+        except Exception as error:
+            if self.breaker is not None and is_connection_error(error):
+                self.breaker_state = 'failing'
+                self.breaker._record_failure(self.remote_key, error)
+            elif isinstance(error, xmlrpc.client.Error) and self.breaker_state != 'closed' and self.breaker is not None:
+                # The remote answered, even if it rejected the call: it is reachable again
+                self.breaker._record_success(self.remote_key)
+                self.breaker_state = 'closed'
+            raise
+        if self.breaker_state != 'closed' and self.breaker is not None:
+            self.breaker._record_success(self.remote_key)
+            self.breaker_state = 'closed'
+        return result
+
+    def has_method(self, model, method):
+        return (model, method) not in self.missing_methods
+
+    def is_missing_method(self, error, model, method):
+        """ Tell whether ``error`` means the remote does not have ``model.method``,
+        and remember it so that the worker does not call it again. """
+        if isinstance(error, xmlrpc.client.Fault) and f"'{model}.{method}' does not exist" in str(error.faultString):
+            _logger.info("Remote %s has no %s.%s endpoint.", self.url, model, method)
+            self.missing_methods.add((model, method))
+            return True
+        return False
+
+    def _time_left(self):
+        """ Return the read timeout of the next call, shortened to the deadline
+        of the current run; refuse the call when the deadline is too close. """
+        run_deadline = getattr(_pool, 'deadline', None)
+        if run_deadline is None:
+            return self.read_timeout
+        remaining = run_deadline - time.monotonic()
+        if remaining < MIN_CALL_SECONDS:
+            raise RemoteDeadlineError(_("The sync run reached its deadline, the remote call was not started."))
+        return min(self.read_timeout, remaining)
+
+
+class RemoteConnection(models.AbstractModel):
+    _name = 'remote.connection'
+    _description = 'Remote Connection Manager'
+
+    @api.model
+    def _get_client(self, url, db, username, password):
+        """ Return the pooled client of the current worker for this remote,
+        creating it on first use or when the credentials changed.
+
+        Raise RemoteUnavailableError right away while the circuit breaker of
+        the remote is open.
+        """
+        breaker = self.env['remote.circuit.breaker'].sudo()
+        breaker_state = breaker._check(f'{url}|{db}')
+
+        clients = getattr(_pool, 'clients', None)
+        if clients is None:
+            clients = _pool.clients = {}
+
+        key = (url, db, username)
+        client = clients.get(key)
+        if client is None or client.password != password:
+            client = clients[key] = RemoteClient(url, db, username, password)
+        client.breaker = breaker
+        client.limiter = self.env['remote.rate.limit'].sudo()
+        if breaker_state == 'half_open':
+            client.breaker_state = breaker_state
+        config_parameters = self.env['ir.config_parameter'].sudo()
+        client.connect_timeout = float(config_parameters.get_param('remote_operations.rpc_connect_timeout', CONNECT_TIMEOUT))
+        client.read_timeout = float(config_parameters.get_param('remote_operations.rpc_read_timeout', READ_TIMEOUT))
+        return client
+
+    @api.model
+    def _get_remote_key(self):
+        """ Same key as ``RemoteClient.remote_key`` for the configured remote, without connecting. """
+        config_parameters = self.env['ir.config_parameter'].sudo()
+        return f"{config_parameters.get_param('remote_operations.url')}|{config_parameters.get_param('remote_operations.db')}"
+
+    @api.model
+    def _payload_hash(self, payload):
+        """ Return a stable fingerprint of a payload sent to the remote, to skip
+        the write when a record is sent again unchanged. """
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    @api.model
+    def _get_client_for_connection(self, db_connection):
+        """ Return the pooled client for a ``db.connection`` record. """
+        return self._get_client(db_connection.url, db_connection.db, db_connection.username, db_connection.password)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api
+import logging
+_logger = logging.getLogger(__name__)
+
+
+class RemoteIdMap(models.Model):
+    _name = 'remote.id.map'
+    _description = 'Remote ID Mapping'
+    _rec_name = 'res_model'
+
+    remote_key = fields.Char(string='Remote Database', required=True)
+    res_model = fields.Char(string='Local Model', required=True)
+    res_id = fields.Integer(string='Local Id', required=True)
+    company_id = fields.Integer(string='Company Key', default=0,
+                                help="Company the mapping was resolved for, 0 when it does not depend on a company.")
+    remote_id = fields.Integer(string='Remote Id', required=True)
+
+    def init(self):
+        # Lookups always go through the full key, so the unique index doubles as the lookup index
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS remote_id_map_key_uniq
+            ON remote_id_map (remote_key, res_model, res_id, company_id)
+        """)
+
+    @api.model
+    def _get_pending(self, models):
+        """ Return the mappings read or stored by the current transaction. They
+        join the worker cache of ``models`` once the transaction is committed,
+        and are dropped with it on a rollback. """
+        callbacks = self.env.cr.postcommit
+        pending = callbacks.data.get(('remote.id.map', models.key))
+        if pending is None:
+            pending = callbacks.data[('remote.id.map', models.key)] = {}
+            callbacks.add(lambda: models.id_cache.update(pending))
+        return pending
+
+    @api.model
+    def _get_cached(self, models, res_model, res_id, company_key):
+        """ Return the cached remote id of a local record of the current database. """
+        key = (self.env.cr.dbname, res_model, res_id, company_key)
+        return self._get_pending(models).get(key) or models.id_cache.get(key)
+
+    @api.model
+    def _lookup(self, models, local_record, company_id=False):
+        """ Return the stored remote id of ``local_record`` or False. """
+        return self._lookup_many(models, local_record, company_id).get(local_record.id, False)
+
+    @api.model
+    def _lookup_many(self, models, local_records, company_id=False):
+        """ Return ``{local id: remote id}`` for the mapped ``local_records``,
+        reading the worker cache first and the table for the rest. """
+        key = company_id or 0
+        result = {}
+        missing = []
+        for res_id in local_records.ids:
+            remote_id = self._get_cached(models, local_records._name, res_id, key)
+            if remote_id:
+                result[res_id] = remote_id
+            else:
+                missing.append(res_id)
+        if missing:
+            self.env.cr.execute("""
+                SELECT res_id, remote_id FROM remote_id_map
+                WHERE remote_key = %s AND res_model = %s AND res_id IN %s AND company_id = %s
+            """, (models.remote_key, local_records._name, tuple(missing), key))
+            pending = self._get_pending(models)
+            for res_id, remote_id in self.env.cr.fetchall():
+                pending[(self.env.cr.dbname, local_records._name, res_id, key)] = remote_id
+                result[res_id] = remote_id
+        return result
+
+    @api.model
+    def _store(self, models, local_record, remote_id, company_id=False):
+        """ Remember the remote id of ``local_record``; concurrent workers
+        resolving the same record are not an error. """
+        if not local_record or not remote_id:
+            return
+        self.env.cr.execute("""
+            INSERT INTO remote_id_map (remote_key, res_model, res_id, company_id, remote_id,
+                                       create_uid, create_date, write_uid, write_date)
+            VALUES (%s, %s, %s, %s, %s, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+            ON CONFLICT (remote_key, res_model, res_id, company_id) DO NOTHING
+        """, (models.remote_key, local_record._name, local_record.id, company_id or 0, remote_id,
+              self.env.uid, self.env.uid))
+        self._get_pending(models)[(self.env.cr.dbname, local_record._name, local_record.id, company_id or 0)] = remote_id
+
+    @api.model
+    def _prefetch(self, models, remote_model, local_records, domain=None, company_id=False, field_name='name'):
+        """ Resolve every unmapped record of ``local_records`` with a single
+        ``search_read`` on ``field_name in [...]`` (and ``domain``) and store
+        the matches, keeping the first remote record per value like the
+        per-record searches do. Unmatched records are left to the regular
+        resolvers. """
+        local_records = local_records.exists()
+        mapped = self._lookup_many(models, local_records, company_id)
+        missing = local_records.filtered(lambda r: r.id not in mapped and r[field_name])
+        if not missing:
+            return
+        values = list(set(missing.mapped(field_name)))
+        remote_records = models.execute_kw(
+            models.db, models.uid, models.password, remote_model, 'search_read',
+            [[(field_name, 'in', values)] + (domain or [])],
+            {'fields': ['id', field_name]}
+        )
+        remote_ids = {}
+        for remote_record in remote_records:
+            remote_ids.setdefault(remote_record[field_name], remote_record['id'])
+        for record in missing:
+            self._store(models, record, remote_ids.get(record[field_name]), company_id)
+        _logger.info("Prefetched %s of %s %s mappings from remote.", len(remote_ids), len(missing), remote_model)
+
+    @api.model
+    def _resolve(self, models, local_record, resolver, company_id=False):
+        """ Return the remote id of ``local_record``, calling ``resolver()``
+        (which does the remote search) only when no mapping is stored yet. """
+        if not local_record:
+            return False
+        local_record.ensure_one()
+        remote_id = self._lookup(models, local_record, company_id)
+        if remote_id:
+            return remote_id
+        remote_id = resolver()
+        self._store(models, local_record, remote_id, company_id)
+        return remote_id
+
+    @api.model
+    def _forget(self, models, res_model, res_ids):
+        """ Drop the mappings of local records, e.g. when the remote record was deleted. """
+        if not res_ids:
+            return
+        self.env.cr.execute("""
+            DELETE FROM remote_id_map WHERE remote_key = %s AND res_model = %s AND res_id IN %s
+        """, (models.remote_key, res_model, tuple(res_ids)))
+        for cache in (models.id_cache, self._get_pending(models)):
+            for key in [key for key in cache if key[:2] == (self.env.cr.dbname, res_model) and key[2] in res_ids]:
+                del cache[key]
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, api, _
+from .remote_connection import RemoteUnavailableError
+import threading
+import time
+import zlib
+import logging
+_logger = logging.getLogger(__name__)
+
+# Defaults of remote_operations.rpc_rate_limit and remote_operations.rpc_max_concurrency
+RATE_LIMIT = 10
+MAX_CONCURRENCY = 4
+# How often a caller waiting for a free call slot checks again
+SLOT_POLL_SECONDS = 0.05
+
+# Token buckets of the process, {remote_key: [tokens, refilled_at]}
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class RemoteRateLimit(models.AbstractModel):
+    """ Throttle of the calls made to a remote database.
+
+    Calls take a token from a bucket of the worker process refilled at
+    ``rpc_rate_limit`` tokens per second (holding at most one second worth of
+    them), then one of the ``rpc_max_concurrency`` call slots. A value of 0
+    disables either limit.
+
+    The bucket is per process on purpose: a bucket shared through the database
+    has to be updated and committed by every call, which serializes all the
+    workers on one row. The ceiling of the remote is therefore
+    ``rpc_rate_limit`` times the number of Odoo processes running the sync.
+    The call slots are shared: a slot is a PostgreSQL transaction-level
+    advisory lock taken on the cursor of the caller, kept for the next calls
+    of the same transaction and freed when the transaction ends, without a
+    connection of its own.
+    """
+    _name = 'remote.rate.limit'
+    _description = 'Remote Rate Limit'
+
+    @api.model
+    def _get_limits(self):
+        config_parameters = self.env['ir.config_parameter'].sudo()
+        rate = float(config_parameters.get_param('remote_operations.rpc_rate_limit', RATE_LIMIT))
+        concurrency = int(config_parameters.get_param('remote_operations.rpc_max_concurrency', MAX_CONCURRENCY))
+        return rate, concurrency
+
+    @api.model
+    def _acquire(self, remote_key, max_wait):
+        """ Wait for a token and a call slot of ``remote_key``, at most
+        ``max_wait`` seconds. """
+        rate, concurrency = self._get_limits()
+        started = time.monotonic()
+        while rate > 0:
+            wait = self._take_token(remote_key, rate)
+            if not wait:
+                break
+            if time.monotonic() - started + wait > max_wait:
+                raise RemoteUnavailableError(_("Too many calls to the remote server %s, try again later.") % remote_key)
+            time.sleep(wait)
+
+        if concurrency <= 0:
+            return
+        # The slot of the transaction is freed when it ends, and so is the
+        # postcommit data it is remembered in
+        held_slots = self.env.cr.postcommit.data.setdefault('remote.rate.limit.slots', {})
+        if remote_key in held_slots:
+            return
+        lock_key = zlib.crc32(remote_key.encode()) & 0x7fffffff
+        while True:
+            for slot in range(concurrency):
+                self.env.cr.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", (lock_key, slot))
+                if self.env.cr.fetchone()[0]:
+                    held_slots[remote_key] = slot
+                    return
+            if time.monotonic() - started + SLOT_POLL_SECONDS > max_wait:
+                raise RemoteUnavailableError(_("Too many calls to the remote server %s, try again later.") % remote_key)
+            time.sleep(SLOT_POLL_SECONDS)
+
+    @api.model
+    def _take_token(self, remote_key, rate):
+        """ Refill the bucket of ``remote_key`` and take a token from it.
+        Return 0 on success, else the seconds until a token is available. """
+        with _buckets_lock:
+            now = time.monotonic()
+            tokens, refilled_at = _buckets.get(remote_key, (max(rate, 1), now))
+            tokens = min(max(rate, 1), tokens + (now - refilled_at) * rate)
+            if tokens >= 1:
+                _buckets[remote_key] = [tokens - 1, now]
+                return 0
+            _buckets[remote_key] = [tokens, now]
+            return (1 - tokens) / rate
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api
+from psycopg2 import IntegrityError
+from .remote_connection import deadline
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import logging
+_logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 10
+MIN_BATCH_SIZE = 1
+MAX_BATCH_SIZE = 500
+# Batches are sized to take about this long, so claims are committed regularly
+TARGET_BATCH_SECONDS = 20.0
+# Above this share of failed records the batch size is halved
+MAX_ERROR_RATE = 0.2
+# Default hard limit of a run, below Odoo's default limit_time_real of 120s
+SYNC_DEADLINE = 100
+
+# Sync worker threads live as long as the process: their pooled remote clients,
+# and so the keep-alive connections, are reused from one run to the next
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(workers):
+    """ Return the worker pool of the process, resized to ``workers`` threads. """
+    global _executor
+    with _executor_lock:
+        if _executor is None or _executor._max_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='remote_sync')
+        return _executor
+
+
+class RemoteSyncChannel(models.Model):
+    _name = 'remote.sync.channel'
+    _description = 'Remote Sync Channel'
+    _rec_name = 'channel'
+
+    channel = fields.Char(string='Channel', required=True, readonly=True)
+    batch_size = fields.Integer(string='Batch Size', default=DEFAULT_BATCH_SIZE)
+    last_run = fields.Datetime(string='Last Run', readonly=True)
+    last_count = fields.Integer(string='Records in Last Run', readonly=True)
+    last_duration = fields.Float(string='Last Run Duration (s)', readonly=True)
+    last_error_rate = fields.Float(string='Last Run Error Rate', readonly=True)
+
+    _sql_constraints = [
+        ('channel_uniq', 'unique(channel)', 'A sync channel can only be defined once.'),
+    ]
+
+    @api.model
+    def _get_channel(self, channel):
+        record = self.search([('channel', '=', channel)], limit=1)
+        if record:
+            return record
+        try:
+            with self.env.cr.savepoint():
+                return self.create({'channel': channel})
+        except IntegrityError:
+            # Another worker created it meanwhile
+            return self.search([('channel', '=', channel)], limit=1)
+
+    @api.model
+    def _run_batches(self, model, method, channel, workers=1):
+        """ Call ``model.method()`` batch after batch until the ``channel`` queue
+        is drained or the ``remote_operations.sync_time_budget`` is spent.
+
+        The batch size, passed through the context to ``_claim_jobs``, follows
+        the observed per-record latency and error rate, and the last size is
+        kept on the channel for the next run. Remote calls that cannot finish
+        before ``remote_operations.sync_deadline`` are refused, so a stuck
+        remote cannot hold the worker until Odoo kills it.
+
+        With several ``workers``, each one drains the queue from a thread of
+        the long-lived worker pool with its own cursor, and the channel is
+        updated once from their stats.
+
+        Within ``remote.sync.job._run_pipeline``, the budget and deadline are
+        the ones left to the whole run, given by the context.
+        """
+        self = self.sudo()
+        remote_key = self.env['remote.connection']._get_remote_key()
+        if self.env['remote.circuit.breaker']._is_open(remote_key):
+            _logger.info("Remote %s is unavailable, channel %s waits for the next run.", remote_key, channel)
+            return
+        budget = float(self.env['ir.config_parameter'].get_param('remote_operations.sync_time_budget', 60))
+        run_deadline = float(self.env['ir.config_parameter'].get_param('remote_operations.sync_deadline', SYNC_DEADLINE))
+        started = time.monotonic()
+        budget_end = min(started + budget, self.env.context.get('remote_sync_budget_end') or float('inf'))
+        deadline_end = min(started + max(run_deadline, budget),
+                           self.env.context.get('remote_sync_deadline_end') or float('inf'))
+        if budget_end <= started:
+            _logger.info("No time left in this run, channel %s waits for the next one.", channel)
+            return
+        record = self._get_channel(channel)
+        batch_size = record.batch_size or DEFAULT_BATCH_SIZE
+
+        if workers <= 1:
+            results = [self._drain(model, method, batch_size, budget_end, deadline_end)]
+        else:
+            args = (self.env.cr.dbname, self.env.uid, self.env.context, model, method, batch_size, budget_end, deadline_end)
+            executor = get_executor(workers)
+            futures = [executor.submit(self._drain_in_worker, *args) for index in range(workers)]
+            results = [result for result in (future.result() for future in futures) if result]
+
+        claimed_total = sum(result['claimed'] for result in results)
+        failed_total = sum(result['failed'] for result in results)
+        if results:
+            batch_size = min(result['batch_size'] for result in results)
+        duration = time.monotonic() - started
+        record.write({
+            'batch_size': batch_size,
+            'last_run': fields.Datetime.now(),
+            'last_count': claimed_total,
+            'last_duration': duration,
+            'last_error_rate': failed_total / claimed_total if claimed_total else 0.0,
+        })
+        _logger.info("Remote sync channel %s: %s records in %.1fs, next batch size %s.",
+                     channel, claimed_total, duration, batch_size)
+
+    @api.model
+    def _drain(self, model, method, batch_size, budget_end, deadline_end):
+        """ Run the batches of one worker and return its stats: the claimed and
+        failed records, and the batch size to start the next run with. """
+        claimed_total = failed_total = 0
+        limit = batch_size
+
+        with deadline(deadline_end - time.monotonic()):
+            while True:
+                stats = {'claimed': 0, 'failed': 0}
+                batch_started = time.monotonic()
+                getattr(self.env[model].with_context(remote_sync_batch_size=limit, remote_sync_stats=stats), method)()
+                if not stats['claimed']:
+                    break
+
+                elapsed = time.monotonic() - batch_started
+                claimed_total += stats['claimed']
+                failed_total += stats['failed']
+                batch_size = self._next_batch_size(batch_size, stats['claimed'], stats['failed'], elapsed)
+                if stats['claimed'] < limit:
+                    break  # Queue drained
+
+                # Do not start a batch that cannot finish within the budget
+                per_record = elapsed / stats['claimed']
+                remaining = budget_end - time.monotonic()
+                limit = min(batch_size, int(remaining / per_record)) if per_record else batch_size
+                if limit < MIN_BATCH_SIZE:
+                    break
+
+        return {'claimed': claimed_total, 'failed': failed_total, 'batch_size': batch_size}
+
+    def _drain_in_worker(self, dbname, uid, context, model, method, batch_size, budget_end, deadline_end):
+        """ Run ``_drain`` from a thread of the worker pool, with its own cursor;
+        return None when it failed. """
+        threading.current_thread().dbname = dbname
+        with self.pool.cursor() as cr:
+            env = api.Environment(cr, uid, context)
+            try:
+                return env['remote.sync.channel']._drain(model, method, batch_size, budget_end, deadline_end)
+            except Exception as e:
+                cr.rollback()
+                _logger.error("Remote sync worker %s.%s failed: %s", model, method, str(e))
+
+    @api.model
+    def _next_batch_size(self, batch_size, claimed, failed, elapsed):
+        """ Size the next batch to take about TARGET_BATCH_SECONDS, at most
+        doubling or halving it per batch, and halve it when too many failed. """
+        if failed / claimed > MAX_ERROR_RATE:
+            new_size = batch_size // 2
+        elif elapsed > 0:
+            new_size = int(TARGET_BATCH_SECONDS * claimed / elapsed)
+            new_size = max(batch_size // 2, min(batch_size * 2, new_size))
+        else:
+            new_size = batch_size * 2
+        return max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, new_size))
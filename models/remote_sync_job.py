@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api, _
+from datetime import timedelta
+import contextlib
+from psycopg2 import OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+import http.client
+import random
+import time
+import xmlrpc.client
+import logging
+from .remote_connection import RemoteUnavailableError
+from .remote_sync_channel import SYNC_DEADLINE
+_logger = logging.getLogger(__name__)
+
+# How long a worker may hold claimed jobs before other workers take them over
+JOB_LEASE_MINUTES = 30
+
+# Transient errors are retried with an exponential backoff before the job is parked
+MAX_ATTEMPTS = 8
+BACKOFF_BASE_SECONDS = 60
+BACKOFF_MAX_SECONDS = 6 * 3600
+# Remote faults caused by concurrent transactions on the remote, not by the data sent
+TRANSIENT_FAULT_MARKERS = (
+    'could not serialize access', 'concurrent update', 'deadlock detected', 'lock not available',
+    'could not obtain lock',
+)
+
+# Channels whose scans start from their remote.sync.watermark
+DATED_CHANNELS = ('journal_entry', 'invoice', 'payment', 'internal_transfer')
+
+# Pending create jobs per dated channel whose contacts are queued ahead of each
+# pipeline run: the ones due first, not the whole backlog
+REFERENCED_PARTNER_SCAN_LIMIT = 500
+
+# Actions replayed on records that already exist on the remote, in order
+DEFERRED_ACTIONS = ('post', 'update', 'reset', 'cancel')
+
+# Stages of the sync pipeline, in dependency order: the contacts of the moves and
+# payments are on the remote before them
+PIPELINE_STAGES = (
+    ('res.partner', 'action_send_partners_to_remote_cron', 'partner'),
+    ('account.move', 'send_account_moves_to_remote', 'journal_entry'),
+    ('account.move', 'action_send_invoice_to_remote_cron', 'invoice'),
+    ('account.payment', 'send_payment_to_remote', 'payment'),
+    ('account.payment', 'send_internal_transfer_payment_to_remote', 'internal_transfer'),
+)
+
+# Channels matched on the remote by name: two workers could both miss the same
+# name and both create it, so they are always run by a single worker
+SINGLE_WORKER_CHANNELS = ('partner', 'currency_rate')
+
+
+class RemoteSyncJob(models.Model):
+    _name = 'remote.sync.job'
+    _description = 'Remote Sync Job'
+    _order = 'next_run, id'
+    _rec_name = 'res_model'
+
+    res_model = fields.Char(string='Model', required=True, readonly=True)
+    res_id = fields.Many2oneReference(string='Record', model_field='res_model', required=True, readonly=True)
+    channel = fields.Selection([
+        ('journal_entry', 'Journal Entry'),
+        ('invoice', 'Invoice'),
+        ('payment', 'Payment'),
+        ('internal_transfer', 'Internal Transfer'),
+        ('currency_rate', 'Currency Rate'),
+        ('partner', 'Contact'),
+        ('pos_stock', 'POS Session Stock'),
+    ], string='Channel', required=True, readonly=True)
+    action = fields.Selection([
+        ('create', 'Create'),
+        ('post', 'Post'),
+        ('update', 'Update'),
+        ('reset', 'Reset to Draft'),
+        ('cancel', 'Cancel'),
+    ], string='Action', required=True, default='create', readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string='State', required=True, default='pending')
+    attempts = fields.Integer(string='Attempts', readonly=True)
+    next_run = fields.Datetime(string='Next Run', default=fields.Datetime.now)
+    last_error = fields.Text(string='Last Error', readonly=True)
+    lease_until = fields.Datetime(string='Claimed Until', readonly=True)
+
+    def init(self):
+        # The crons only ever look at the pending jobs of one channel, keep that part of the table small to scan
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS remote_sync_job_pending_idx
+            ON remote_sync_job (channel, action, next_run, id) WHERE state = 'pending'
+        """)
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS remote_sync_job_running_idx
+            ON remote_sync_job (lease_until) WHERE state = 'running'
+        """)
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS remote_sync_job_record_idx
+            ON remote_sync_job (res_model, res_id)
+        """)
+
+    @api.model
+    def _get_channel_domains(self, scan=False):
+        """ Return ``{channel: (model, domain)}`` where ``domain`` selects the
+        records of the channel that still have to be created on the remote.
+
+        With ``scan``, the dated channels start from their watermark instead of
+        the sync start date, so scanning for missed records does not get slower
+        as the history grows.
+        """
+        watermark_obj = self.env['remote.sync.watermark']
+        start_date = watermark_obj._get_start_date()
+
+        def since(channel):
+            return ('date', '>=', fields.Date.to_string(watermark_obj._get_date(channel) if scan else start_date))
+
+        domains = {
+            'journal_entry': ('account.move', [
+                ('posted_to_remote', '=', False), ('state', '=', 'posted'), ('move_type', '=', 'entry'),
+                ('journal_id.type', '=', 'general'), ('failed_to_sync', '=', False), since('journal_entry'),
+                ('no_allow_sync', '=', False), ('journal_id.dont_synchronize', '=', False),
+            ]),
+            'invoice': ('account.move', [
+                ('posted_to_remote', '=', False), ('state', '=', 'posted'), ('move_type', '!=', 'entry'),
+                ('failed_to_sync', '=', False), since('invoice'), ('no_allow_sync', '=', False),
+                ('journal_id.dont_synchronize', '=', False),
+            ]),
+            'payment': ('account.payment', [
+                ('payment_posted_to_remote', '=', False), ('no_allow_sync', '=', False),
+                ('is_internal_transfer', '=', False), since('payment'), ('state', '=', 'posted'),
+                ('failed_to_sync', '=', False), ('journal_id.dont_synchronize', '=', False),
+            ]),
+            'internal_transfer': ('account.payment', [
+                ('payment_posted_to_remote', '=', False), ('no_allow_sync', '=', False),
+                ('is_internal_transfer', '=', True), since('internal_transfer'), ('state', '=', 'posted'),
+                ('payment_type', '=', 'outbound'), ('failed_to_sync', '=', False),
+                ('journal_id.dont_synchronize', '=', False),
+            ]),
+            'currency_rate': ('res.currency.rate', [
+                ('posted_to_remote', '=', False), ('failed_to_sync', '=', False),
+                self.env['res.currency.rate']._get_remote_currency_domain(),
+            ]),
+            'partner': ('res.partner', [
+                ('sent_to_remote', '=', False),
+            ]),
+        }
+        if self._has_pos_stock_sync():
+            domains['pos_stock'] = ('pos.session', [
+                ('stock_posted_to_remote', '=', False), ('state', '=', 'closed'),
+                ('stop_at', '>=', fields.Date.to_string(start_date)),
+            ])
+        return domains
+
+    @api.model
+    def _has_pos_stock_sync(self):
+        """ Tell whether the stock of the POS sessions is pushed to the remote. """
+        return 'pos.session' in self.env and 'stock_posted_to_remote' in self.env['pos.session']._fields
+
+    @api.model
+    def _enqueue(self, records, channel, action='create'):
+        """ Add a pending job for each of ``records`` that does not have one yet.
+
+        Deferred actions must be replayed in order (a reset has to reach the
+        remote before the update that follows it), so they are only merged
+        with the last pending job of the record when it is the same action.
+
+        Only a branch database sends its records to the remote, nothing is
+        queued on the others.
+        """
+        if not records or not self._is_branch_database():
+            return self.browse()
+        if action in DEFERRED_ACTIONS:
+            last_jobs = {}
+            for job in self.search([
+                ('res_model', '=', records._name), ('res_id', 'in', records.ids),
+                ('action', 'in', DEFERRED_ACTIONS), ('state', '=', 'pending'),
+            ], order='id'):
+                last_jobs[job.res_id] = job
+            existing = self.browse([job.id for job in last_jobs.values() if job.action == action])
+        else:
+            existing = self.search([
+                ('res_model', '=', records._name), ('res_id', 'in', records.ids),
+                ('action', '=', action), ('state', '=', 'pending'),
+            ])
+        queued_ids = set(existing.mapped('res_id'))
+        jobs = self.create([{
+            'res_model': records._name,
+            'res_id': record.id,
+            'channel': channel,
+            'action': action,
+        } for record in records if record.id not in queued_ids])
+        return existing | jobs
+
+    @api.model
+    def _is_branch_database(self):
+        return self.env['ir.config_parameter'].sudo().get_param('remote_operations.remote_type') == 'Branch Database'
+
+    @api.model
+    def _enqueue_eligible(self, records, channel):
+        """ Enqueue a creation job for the ``records`` matching the channel domain. """
+        model, domain = self._get_channel_domains()[channel]
+        return self._enqueue(records.sudo().filtered_domain(domain), channel)
+
+    @api.model
+    def _enqueue_backlog(self):
+        """ Enqueue the records waiting for a remote creation that have no job yet,
+        e.g. the ones posted before the queue existed. """
+        if not self._is_branch_database():
+            return
+        watermark_obj = self.env['remote.sync.watermark']
+        for channel, (model, domain) in self._get_channel_domains(scan=True).items():
+            jobs = self.search([('res_model', '=', model), ('channel', '=', channel), ('state', 'in', ('pending', 'running', 'failed'))])
+            records = self.env[model].sudo().search(domain + [('id', 'not in', jobs.mapped('res_id'))])
+            if records:
+                self._enqueue(records, channel)
+                _logger.info("Enqueued %s %s records waiting for remote sync.", len(records), channel)
+            if channel in DATED_CHANNELS:
+                watermark_obj._advance(channel, model, domain)
+
+    @api.model
+    def _claim_jobs(self, channel, limit, actions=('create',)):
+        """ Claim up to ``limit`` due pending jobs of ``channel`` (one channel or
+        a list of them), oldest first.
+
+        The work of the caller, e.g. the results of its previous batch, is
+        committed first. The rows are then picked with ``FOR UPDATE SKIP LOCKED``
+        and flagged as running on a cursor of their own that only commits the
+        claim, so concurrent workers always get disjoint batches and a claim
+        never rolls back the bookkeeping of records already sent. Jobs of a
+        worker that died are released once their lease expired.
+
+        When run by ``remote.sync.channel._run_batches``, the adaptive batch
+        size from the context replaces ``limit``.
+        """
+        limit = self.env.context.get('remote_sync_batch_size') or limit
+        channels = (channel,) if isinstance(channel, str) else tuple(channel)
+        self.env.cr.commit()
+        with self.pool.cursor() as cr:
+            cr.execute("""
+                UPDATE remote_sync_job SET state = 'pending', lease_until = NULL
+                WHERE id IN (
+                    SELECT id FROM remote_sync_job
+                    WHERE state = 'running' AND lease_until < now() at time zone 'UTC'
+                    FOR UPDATE SKIP LOCKED
+                )
+            """)
+            cr.execute("""
+                UPDATE remote_sync_job SET state = 'running',
+                       lease_until = now() at time zone 'UTC' + make_interval(mins => %s)
+                WHERE id IN (
+                    SELECT id FROM remote_sync_job
+                    WHERE state = 'pending' AND channel IN %s AND action IN %s
+                      AND next_run <= now() at time zone 'UTC'
+                    ORDER BY next_run, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id
+            """, (JOB_LEASE_MINUTES, channels, tuple(actions), limit))
+            job_ids = [row[0] for row in cr.fetchall()]
+        # The jobs were read by the caller before the claim was committed
+        self.browse(job_ids).invalidate_recordset(['state', 'lease_until'])
+        stats = self.env.context.get('remote_sync_stats')
+        if stats is not None:
+            stats['claimed'] += len(job_ids)
+        return self.browse(job_ids).sorted()
+
+    @api.model
+    def _run_in_workers(self, model, method, channel):
+        """ Run the ``channel`` batches of ``model.method()`` in
+        ``remote_operations.sync_workers`` threads, each with its own cursor and
+        remote connection. The methods claim their jobs with ``_claim_jobs`` so
+        every worker pushes a disjoint batch. The SINGLE_WORKER_CHANNELS always
+        run in one worker. """
+        workers = int(self.env['ir.config_parameter'].sudo().get_param('remote_operations.sync_workers', 1))
+        if channel in SINGLE_WORKER_CHANNELS:
+            workers = 1
+        return self._run_stage(model, method, channel, workers)
+
+    @api.model
+    def _run_pipeline(self):
+        """ Cron: run the PIPELINE_STAGES one after the other, sharing the
+        ``remote_operations.sync_time_budget`` and ``sync_deadline`` of the run.
+
+        The contacts referenced by the queued moves and payments are queued
+        first, so the partner stage maps them and the later stages find them in
+        ``remote.id.map`` instead of creating them one by one.
+        """
+        self = self.sudo()
+        self._enqueue_referenced_partners()
+        self.env.cr.commit()
+
+        config_parameters = self.env['ir.config_parameter']
+        budget = float(config_parameters.get_param('remote_operations.sync_time_budget', 60))
+        run_deadline = float(config_parameters.get_param('remote_operations.sync_deadline', SYNC_DEADLINE))
+        started = time.monotonic()
+        pipeline = self.with_context(
+            remote_sync_budget_end=started + budget,
+            remote_sync_deadline_end=started + max(run_deadline, budget),
+        )
+        for model, method, channel in PIPELINE_STAGES:
+            try:
+                pipeline._run_in_workers(model, method, channel)
+            except Exception as e:
+                self.env.cr.rollback()
+                _logger.error("Remote sync stage %s.%s failed: %s", model, method, str(e))
+
+    @api.model
+    def _enqueue_referenced_partners(self):
+        """ Enqueue the contacts of the moves and payments due for their remote
+        creation that are not on the remote yet. Only the next
+        REFERENCED_PARTNER_SCAN_LIMIT jobs of each channel are read, so a large
+        backlog is not scanned on every run. """
+        now = fields.Datetime.now()
+        jobs = self.browse()
+        for channel in DATED_CHANNELS:
+            jobs |= self.search([
+                ('state', '=', 'pending'), ('action', '=', 'create'), ('channel', '=', channel),
+                ('next_run', '<=', now),
+            ], order='next_run, id', limit=REFERENCED_PARTNER_SCAN_LIMIT)
+        moves = jobs.filtered(lambda j: j.res_model == 'account.move')._get_records('account.move')
+        payments = jobs.filtered(lambda j: j.res_model == 'account.payment')._get_records('account.payment')
+        partners = (moves.partner_id | moves.line_ids.partner_id | payments.partner_id).filtered(
+            lambda p: not p.sent_to_remote)
+        return self._enqueue(partners, 'partner')
+
+    @api.model
+    def _run_stage(self, model, method, channel, workers=1):
+        """ Run the ``channel`` batches of ``model.method()``. A failure is logged
+        and the uncommitted work of the stage rolled back, so that the next
+        stages of the pipeline still run. """
+        try:
+            self.env['remote.sync.channel']._run_batches(model, method, channel, workers)
+        except Exception as e:
+            self.env.cr.rollback()
+            _logger.error("Remote sync stage %s.%s failed: %s", model, method, str(e))
+
+    @contextlib.contextmanager
+    def _fail_on_error(self):
+        """ Record an error raised while working on the claimed jobs on the ones
+        still running before passing it on, so they are retried with a backoff
+        instead of staying claimed until their lease expires. """
+        try:
+            yield
+        except Exception as e:
+            # The bookkeeping of the records already sent is kept, unless a
+            # database error aborted the transaction anyway
+            if self.env.cr._cnx.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+                self.env.cr.rollback()
+            self.filtered(lambda j: j.state == 'running')._set_failed(e)
+            self.env.cr.commit()
+            raise
+
+    def _get_records(self, model):
+        """ Return the existing ``model`` records of the jobs. """
+        return self.env[model].browse(list(dict.fromkeys(self.mapped('res_id')))).exists()
+
+    @api.model
+    def _find_pending(self, records, actions=None):
+        """ Return the pending or running jobs of ``records``. """
+        domain = [('res_model', '=', records._name), ('res_id', 'in', records.ids), ('state', 'in', ('pending', 'running'))]
+        if actions:
+            domain.append(('action', 'in', list(actions)))
+        return self.search(domain)
+
+    def _set_done(self):
+        self.write({'state': 'done', 'last_error': False, 'lease_until': False})
+
+    def _set_failed(self, error):
+        """ Schedule another attempt with an exponential backoff and jitter when
+        ``error`` is transient, park the jobs as failed otherwise or once they
+        ran out of attempts. Calls refused before reaching the remote (open
+        circuit breaker, rate limit, deadline of the run) are rescheduled
+        without counting as an attempt. """
+        stats = self.env.context.get('remote_sync_stats')
+        if stats is not None:
+            stats['failed'] += len(self)
+        transient = self._is_transient_error(error)
+        refused = self._is_refused_call(error)
+        for job in self:
+            attempts = job.attempts if refused else job.attempts + 1
+            vals = {'attempts': attempts, 'last_error': str(error), 'lease_until': False}
+            if refused or (transient and attempts < MAX_ATTEMPTS):
+                delay = self._backoff_delay(max(attempts, 1))
+                vals.update(state='pending', next_run=fields.Datetime.now() + timedelta(seconds=delay))
+                _logger.warning("Remote sync job %s failed (attempt %s), retrying at %s: %s",
+                                job.id, attempts, vals['next_run'], str(error))
+            else:
+                vals['state'] = 'failed'
+            job.write(vals)
+
+    @api.model
+    def _record_failed(self, records, error, actions=None):
+        """ Record ``error`` on the pending jobs of ``records``; return whether
+        another attempt was scheduled. """
+        jobs = self._find_pending(records, actions)
+        jobs._set_failed(error)
+        return any(job.state == 'pending' for job in jobs)
+
+    @api.model
+    def _is_refused_call(self, error):
+        """ Tell whether ``error``, or an error it was raised from, is a call
+        refused before it was sent to the remote. """
+        while error is not None:
+            if isinstance(error, RemoteUnavailableError):
+                return True
+            error = error.__cause__ or error.__context__
+        return False
+
+    @api.model
+    def _is_transient_error(self, error):
+        """ Tell whether ``error``, or an error it was raised from, is worth
+        retrying as is: network failures, 429/5xx answers and lock conflicts.
+        Anything else (e.g. a missing remote mapping) needs a fix first. """
+        while error is not None:
+            if isinstance(error, RemoteUnavailableError):
+                return True
+            if isinstance(error, xmlrpc.client.ProtocolError):
+                return error.errcode == 429 or error.errcode >= 500
+            if isinstance(error, (OSError, http.client.HTTPException, OperationalError)):
+                return True
+            if isinstance(error, xmlrpc.client.Fault):
+                return any(marker in str(error.faultString).lower() for marker in TRANSIENT_FAULT_MARKERS)
+            error = error.__cause__ or error.__context__
+        return False
+
+    @api.model
+    def _backoff_delay(self, attempts):
+        """ Seconds to wait before attempt ``attempts + 1``; the jitter spreads
+        the retries of a batch that failed during the same outage. """
+        delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    @api.model
+    def _run_deferred_jobs(self):
+        """ Cron: replay the update, reset and cancel jobs queued by the
+        posting, reset and cancel buttons of already synced moves, and the post
+        jobs of remote moves created but not posted yet. """
+        self._claim_jobs(('journal_entry', 'invoice'), 10, actions=DEFERRED_ACTIONS)._run()
+
+    @api.model
+    def _run_pos_stock_jobs(self):
+        """ Cron: push the stock of the closed POS sessions queued for the remote. """
+        if self._has_pos_stock_sync():
+            self.env['remote.sync.channel']._run_batches('pos.session', 'send_stock_to_remote', 'pos_stock')
+
+    @api.model
+    def _trigger_deferred_runner(self):
+        """ Wake the deferred job runner up once the current transaction is committed. """
+        cron = self.env.ref('remote_operations.ir_cron_remote_sync_deferred', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+
+    def _run(self):
+        """ Run the claimed deferred jobs, one transaction per job. """
+        for job in self.filtered(lambda j: j.state in ('pending', 'running') and j.action != 'create'):
+            record = self.env[job.res_model].browse(job.res_id).exists()
+            if not record:
+                job._set_done()
+                self.env.cr.commit()
+                continue
+            # An earlier action of the record waits for a retry, keep the order
+            earlier = self.search([
+                ('res_model', '=', job.res_model), ('res_id', '=', job.res_id), ('action', 'in', DEFERRED_ACTIONS),
+                ('state', '=', 'pending'), ('id', '<', job.id),
+            ], order='next_run desc', limit=1)
+            if earlier:
+                job.write({'state': 'pending', 'lease_until': False, 'next_run': earlier.next_run})
+                self.env.cr.commit()
+                continue
+            try:
+                record._run_remote_sync_job(job.action)
+                job._set_done()
+            except Exception as e:
+                # A database error aborted the transaction of the job
+                self.env.cr.rollback()
+                _logger.error("Remote sync job %s (%s %s on %s,%s) failed: %s",
+                              job.id, job.channel, job.action, job.res_model, job.res_id, str(e))
+                job._set_failed(e)
+            self.env.cr.commit()
+
+    def action_retry(self):
+        """ Put failed jobs back in the queue and clear the failure flag of their records. """
+        for job in self.filtered(lambda j: j.state == 'failed'):
+            record = self.env[job.res_model].browse(job.res_id).exists()
+            if record and 'failed_to_sync' in record._fields:
+                record.sudo().write({'failed_to_sync': False})
+            job.write({'state': 'pending', 'attempts': 0, 'next_run': fields.Datetime.now()})
+        return True
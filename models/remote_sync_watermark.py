@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api
+import logging
+_logger = logging.getLogger(__name__)
+
+# Records dated before this are never sent, unless remote_operations.sync_start_date says otherwise
+DEFAULT_SYNC_START_DATE = '2024-07-01'
+
+
+class RemoteSyncWatermark(models.Model):
+    _name = 'remote.sync.watermark'
+    _description = 'Remote Sync Watermark'
+    _rec_name = 'channel'
+
+    remote_key = fields.Char(string='Remote Database', required=True, readonly=True)
+    channel = fields.Char(string='Channel', required=True, readonly=True)
+    date = fields.Date(string='Synced Until', required=True,
+                       help="Every record of the channel dated before this day is synced or parked.")
+
+    _sql_constraints = [
+        ('channel_uniq', 'unique(remote_key, channel)', 'A channel can only have one watermark per remote.'),
+    ]
+
+    @api.model
+    def _get_start_date(self):
+        """ Return the first date the branch sends to the remote. """
+        return fields.Date.to_date(
+            self.env['ir.config_parameter'].sudo().get_param('remote_operations.sync_start_date', DEFAULT_SYNC_START_DATE))
+
+    @api.model
+    def _get_date(self, channel):
+        """ Return the date the scans of ``channel`` can start from. """
+        remote_key = self.env['remote.connection']._get_remote_key()
+        watermark = self.sudo().search([('remote_key', '=', remote_key), ('channel', '=', channel)], limit=1)
+        start_date = self._get_start_date()
+        return max(watermark.date, start_date) if watermark else start_date
+
+    @api.model
+    def _advance(self, channel, model, domain):
+        """ Move the watermark of ``channel`` up to the oldest ``model`` record
+        still matching ``domain``, or to today when none is left. Records posted
+        later with an older date are queued by their posting, not by the scans. """
+        oldest = self.env[model].sudo().search(domain, order='date, id', limit=1)
+        new_date = oldest.date if oldest else fields.Date.context_today(self)
+        remote_key = self.env['remote.connection']._get_remote_key()
+        watermark = self.sudo().search([('remote_key', '=', remote_key), ('channel', '=', channel)], limit=1)
+        if not watermark:
+            self.sudo().create({'remote_key': remote_key, 'channel': channel, 'date': new_date})
+        elif new_date > watermark.date:
+            watermark.date = new_date
+            _logger.info("Remote sync watermark of %s moved to %s.", channel, new_date)
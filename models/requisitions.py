@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+# Not imported by models/__init__.py: item.requisition comes from a module this
+# one does not depend on, so nothing in this file is active yet.
 
-from odoo import models, fields, api, _
+from odoo import models, fields, api, tools, _
+from collections import defaultdict
 import requests, json, base64
 from datetime import datetime, date
 from odoo.exceptions import ValidationError, UserError
@@ -28,16 +31,12 @@ class ItemRequisition(models.Model):
 
         if remote_type == 'Branch Database':
             # Search for a virtual location marked as the default_virtual_location
-            default_virtual_location = self.env['stock.location'].search([('default_virtual_location', '=', True)], limit=1)
-            if default_virtual_location:
-                return default_virtual_location.id
+            default_virtual_location_id = self._get_flagged_location_id('default_virtual_location')
+            if default_virtual_location_id:
+                return default_virtual_location_id
 
         # Fallback to existing logic for non-branch databases
-        picking_type = self.env['stock.picking.type'].search([('code', '=', 'internal')], limit=1)
-        if picking_type and picking_type.default_location_src_id:
-            return picking_type.default_location_src_id.id
-
-        return False
+        return self._get_internal_source_location_id() or False
     
     @api.model
     def _default_destination_location(self):
@@ -46,12 +45,29 @@ class ItemRequisition(models.Model):
 
         if remote_type == 'Branch Database':
             # Search for a virtual location marked as the default destination location
-            default_destination_location = self.env['stock.location'].search([('default_destination', '=', True)], limit=1)
-            if default_destination_location:
-                return default_destination_location.id
+            default_destination_location_id = self._get_flagged_location_id('default_destination')
+            if default_destination_location_id:
+                return default_destination_location_id
             else:
                 raise models.ValidationError("Please configure a defualt destination location to complete this requisition!")
 
+    @api.model
+    @tools.ormcache('self.env.uid', 'tuple(self.env.companies.ids)', 'flag')
+    def _get_flagged_location_id(self, flag):
+        """ Return the id of the first location with the boolean ``flag`` set.
+        Cached in the registry per user and companies, as the search follows
+        their record rules, until a flagged location changes, see StockLocation. """
+        return self.env['stock.location'].search([(flag, '=', True)], limit=1).id
+
+    @api.model
+    @tools.ormcache('self.env.uid', 'tuple(self.env.companies.ids)')
+    def _get_internal_source_location_id(self):
+        """ Return the default source location of the first internal picking type.
+        Cached in the registry per user and companies until an internal picking
+        type changes, see StockPickingType. """
+        picking_type = self.env['stock.picking.type'].search([('code', '=', 'internal')], limit=1)
+        return picking_type.default_location_src_id.id
+
 
 
     def submit_for_approval(self):
@@ -82,9 +98,8 @@ class ItemRequisition(models.Model):
 
         # Create XML-RPC connection and send data
         try:
-            common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(url))
-            uid = common.authenticate(db, username, password, {})
-            models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(url))
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
 
             # Prepare the requisition data
             requisition_data = self._prepare_stacafe_remote_operations_values(models, db, uid, password, base_url)            
@@ -173,14 +188,8 @@ class ItemRequisition(models.Model):
         if remote_type != 'Main Database':
             return True
 
-        for rec in self:
-
-            # Ensure remote_record_id and database_connection_id are set
-            if not rec.remote_record_id or not rec.remote_database_id:
-                continue
-
-            # Get configuration parameters
-            db_connection = rec.remote_database_id
+        # One call per branch for all its requisitions
+        for db_connection, requisitions in self._group_by_remote_database().items():
             url = db_connection.url
             db = db_connection.db
             username = db_connection.username
@@ -192,32 +201,51 @@ class ItemRequisition(models.Model):
 
             # Create XML-RPC connection and send data
             try:
-                common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(url))
-                uid = common.authenticate(db, username, password, {})
+                models = self.env['remote.connection']._get_client_for_connection(db_connection)
+                uid = models.uid
                 if not uid:
                     raise ValidationError("Failed to authenticate with the remote server.")
-                
-                models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(url))
 
                 # Send the name of the user that approved the requisition
                 user_name = self.env.user.name
                 _logger.info("Sending approved user name to remote: %s", user_name)
 
-                models.execute_kw(db, uid, password, 'item.requisition', 'approve', [[rec.remote_record_id]])
-                # models.execute_kw(db, uid, password, 'item.requisition', 'write', [[rec.remote_record_id], {'user_name': user_name}])
-                _logger.info("Updated user_name for remote record ID: %s", rec.remote_record_id)
+                remote_ids = requisitions.mapped('remote_record_id')
+                models.execute_kw(db, uid, password, 'item.requisition', 'approve', [remote_ids])
+                # models.execute_kw(db, uid, password, 'item.requisition', 'write', [remote_ids, {'user_name': user_name}])
+                _logger.info("Approved remote record IDs: %s", remote_ids)
 
             except Exception as e:
                 raise ValidationError("Error while updating user name on remote server: {}".format(e))
 
         return True
 
+    def _group_by_remote_database(self):
+        """ Return ``{db.connection: requisitions}`` for the requisitions of
+        ``self`` that come from a branch. """
+        groups = defaultdict(lambda: self.browse())
+        for rec in self:
+            if rec.remote_record_id and rec.remote_database_id:
+                groups[rec.remote_database_id] |= rec
+        return groups
+
     def action_approve_item_requisition(self):
         # Check if the database is configured as "Branch Database" or "Main Database"
         config_parameters = self.env['ir.config_parameter'].sudo()
         remote_type = config_parameters.get_param('stacafe_remote_operations.remote_type')
 
         if self.order_line:
+            from_branches = self.browse()
+            pick_vals_list = []
+            quant_vals_list = []
+
+            # The lines take the current cost of their product, one write per distinct cost
+            lines_by_price = defaultdict(lambda: self.env['item.requisition.order.line'])
+            for rec in self.order_line:
+                lines_by_price[rec.product_id.standard_price] |= rec
+            for unit_price, lines in lines_by_price.items():
+                lines.write({'unit_price': unit_price})
+
             for data in self:
                 if not data.destination1:
                     raise ValidationError(_("Please provide the destination for the items requested!"))
@@ -225,10 +253,9 @@ class ItemRequisition(models.Model):
                 source_location_id = False
                 if remote_type == 'Branch Database':
                     # Get the default virtual location
-                    default_virtual_location = self.env['stock.location'].search([('default_virtual_location', '=', True)], limit=1)
-                    if not default_virtual_location:
+                    source_location_id = self._get_flagged_location_id('default_virtual_location')
+                    if not source_location_id:
                         raise ValidationError(_("No default virtual location found. Please configure a location with 'default_virtual_location' set to True."))
-                    source_location_id = default_virtual_location.id
                 else:
                     if data.source1:
                         source_location_id = data.source1.id
@@ -236,12 +263,8 @@ class ItemRequisition(models.Model):
                 if not source_location_id:
                     raise ValidationError(_("Please provide the source for the items requested!"))
 
-                move_obj = self.env['stock.move']
-                pick_obj = self.env["stock.picking"]
-
                 move_vals = []
                 for rec in data.order_line:
-                    rec.unit_price = rec.product_id.standard_price
                     move_vals.append([0, 0, {
                         'name': '(' + str(rec.product_id.name) + ') requested from ' + str(data.name),
                         'product_id': rec.product_id.id,
@@ -254,7 +277,7 @@ class ItemRequisition(models.Model):
                         'requisition_id': data.id,
                     }])
 
-                pick_values = {
+                pick_vals_list.append({
                     'note': 'Items requested by ' + str(self.env.user.name),
                     'location_dest_id': data.destination1.id,
                     'location_id': source_location_id,
@@ -263,19 +286,11 @@ class ItemRequisition(models.Model):
                     'picking_type_id': data.get_default_internal_picking_type(),  # check correct picking type ID
                     'origin': data.name,
                     'requisition_id': data.id,
-                }
-
-                pick_id = pick_obj.create(pick_values)
-                pick_id.action_confirm()
-                pick_id.button_validate()
-                self.write({'picking_id': pick_id.id})
-                data.write({'state': 'done', 'user_complete': self.env.uid})
+                })
 
                 if remote_type == 'Main Database' and data.remote_record_id or data.remote_database_id:
-
-                    custom_stock_quant_obj = self.env['custom.stock.quant']
                     for rec in data.order_line:
-                        custom_stock_quant_obj.create({
+                        quant_vals_list.append({
                             'product_id': rec.product_id.id,
                             'product_uom_id': rec.product_uom.id,
                             'date': date.today(),
@@ -285,20 +300,30 @@ class ItemRequisition(models.Model):
                             'destination_id': data.destination1.id,
                         })
 
-                    self._call_remote_approve()
+                    from_branches |= data
 
+            # All the pickings are created, confirmed and validated together
+            pickings = self.env["stock.picking"].create(pick_vals_list)
+            pickings.action_confirm()
+            pickings.button_validate()
+            for data, pick_id in zip(self, pickings):
+                data.picking_id = pick_id
+            self.write({'state': 'done', 'user_complete': self.env.uid})
+            self.env['custom.stock.quant'].create(quant_vals_list)
+
+            from_branches._call_remote_approve()
             return True
         else:
             raise ValidationError(_('You must provide at least one product to complete this request'))
 
     def _call_remote_approve(self):
+        # Ensure remote_record_id and remote_database_id are set
         for data in self:
-            # Ensure remote_record_id and remote_database_id are set
             if not data.remote_record_id or not data.remote_database_id:
                 raise ValidationError(_("Remote record ID or remote database connection is not set."))
 
-            # Get the remote connection details
-            db_connection = data.remote_database_id
+        # One connection and a handful of calls per branch, whatever the number of requisitions
+        for db_connection, requisitions in self._group_by_remote_database().items():
             url = db_connection.url
             db = db_connection.db
             username = db_connection.username
@@ -310,19 +335,18 @@ class ItemRequisition(models.Model):
 
             try:
                 # Create XML-RPC connection and call the remote method
-                common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(url))
-                uid = common.authenticate(db, username, password, {})
+                models = self.env['remote.connection']._get_client_for_connection(db_connection)
+                uid = models.uid
                 if not uid:
                     raise ValidationError("Failed to authenticate with the remote server.")
-                
-                models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(url))
 
                 # Search for corresponding remote order lines in a single query
-                domain = [('order_id', '=', data.remote_record_id)]
-                remote_lines = models.execute_kw(db, uid, password, 'item.requisition.order.line', 'search_read', [domain], {'fields': ['id', 'product_id']})
+                remote_ids = requisitions.mapped('remote_record_id')
+                domain = [('order_id', 'in', remote_ids)]
+                remote_lines = models.execute_kw(db, uid, password, 'item.requisition.order.line', 'search_read', [domain], {'fields': ['id', 'product_id', 'order_id']})
 
-                # Map the remote order lines by product_id
-                remote_line_map = {line['product_id'][1]: line['id'] for line in remote_lines}
+                # Map the remote order lines by requisition and product_id
+                remote_line_map = {(line['order_id'][0], line['product_id'][1]): line['id'] for line in remote_lines}
                 _logger.info("Remote line map "+str(remote_line_map))
 
                 # Prepare the updates in batch
@@ -336,19 +360,24 @@ class ItemRequisition(models.Model):
                 
                 # _logger.info("Updates "+str(updates))
 
-                # Perform the updates individually to avoid passing a list where a single value is expected
-                for line in data.order_line:
-                    remote_line_id = remote_line_map.get(line.product_id.name)
-                    if remote_line_id:
-                        models.execute_kw(db, uid, password, 'item.requisition.order.line', 'write', [[remote_line_id], {'unit_price': line.product_id.standard_price}])
-                        _logger.info("Updated unit_price for remote order line ID: %s (Product Name: %s)", remote_line_id, line.product_id.name)
-                    else:
-                        _logger.warning("No matching remote order line found for Product Name: %s in remote requisition ID: %s", line.product_id.name, data.remote_record_id)
-
-
-                # Call the action_approve_item_requisition method on the remote record
-                result = models.execute_kw(db, uid, password, 'item.requisition', 'action_approve_item_requisition', [[data.remote_record_id]])
-                _logger.info("Called remote action_approve_item_requisition for record ID: %s", data.remote_record_id)
+                # Group the remote lines by price, one write per distinct price
+                lines_by_price = defaultdict(list)
+                for data in requisitions:
+                    for line in data.order_line:
+                        remote_line_id = remote_line_map.get((data.remote_record_id, line.product_id.name))
+                        if remote_line_id:
+                            lines_by_price[line.product_id.standard_price].append(remote_line_id)
+                        else:
+                            _logger.warning("No matching remote order line found for Product Name: %s in remote requisition ID: %s", line.product_id.name, data.remote_record_id)
+
+                for unit_price, remote_line_ids in lines_by_price.items():
+                    models.execute_kw(db, uid, password, 'item.requisition.order.line', 'write', [remote_line_ids, {'unit_price': unit_price}])
+                _logger.info("Updated unit_price of %s remote order lines in %s calls.",
+                             sum(len(ids) for ids in lines_by_price.values()), len(lines_by_price))
+
+                # Call the action_approve_item_requisition method on the remote records
+                result = models.execute_kw(db, uid, password, 'item.requisition', 'action_approve_item_requisition', [remote_ids])
+                _logger.info("Called remote action_approve_item_requisition for record IDs: %s", remote_ids)
 
             except Exception as e:
                 raise ValidationError("Error while calling remote action_approve_item_requisition: {}".format(e))
@@ -364,6 +393,74 @@ class StockLocation(models.Model):
     default_virtual_location = fields.Boolean("Default Virtual Location")
     default_destination = fields.Boolean("Default Destination Location")
 
+    # Fields deciding which location ItemRequisition._get_flagged_location_id returns
+    _REQUISITION_DEFAULT_FIELDS = {'default_virtual_location', 'default_destination', 'active', 'company_id'}
+
+    def _is_requisition_default(self):
+        return any(location.default_virtual_location or location.default_destination for location in self)
+
+    def _clear_requisition_default_cache(self):
+        # Odoo 16 has no per-method clear, this one is registry wide: only call
+        # it when a flagged location changes
+        self.env['item.requisition']._get_flagged_location_id.clear_cache(self.env['item.requisition'])
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        locations = super(StockLocation, self).create(vals_list)
+        if locations._is_requisition_default():
+            locations._clear_requisition_default_cache()
+        return locations
+
+    def write(self, vals):
+        relevant = self._REQUISITION_DEFAULT_FIELDS.intersection(vals)
+        flagged = relevant and self._is_requisition_default()
+        result = super(StockLocation, self).write(vals)
+        if relevant and (flagged or self._is_requisition_default()):
+            self._clear_requisition_default_cache()
+        return result
+
+    def unlink(self):
+        flagged = self._is_requisition_default()
+        result = super(StockLocation, self).unlink()
+        if flagged:
+            self._clear_requisition_default_cache()
+        return result
+
+class StockPickingType(models.Model):
+    _inherit = 'stock.picking.type'
+
+    # Fields deciding which location ItemRequisition._get_internal_source_location_id returns
+    _REQUISITION_DEFAULT_FIELDS = {'code', 'default_location_src_id', 'sequence', 'active', 'company_id'}
+
+    def _is_internal(self):
+        return any(picking_type.code == 'internal' for picking_type in self)
+
+    def _clear_requisition_default_cache(self):
+        # Registry wide in Odoo 16, see StockLocation: only for internal picking types
+        self.env['item.requisition']._get_internal_source_location_id.clear_cache(self.env['item.requisition'])
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        picking_types = super(StockPickingType, self).create(vals_list)
+        if picking_types._is_internal():
+            picking_types._clear_requisition_default_cache()
+        return picking_types
+
+    def write(self, vals):
+        relevant = self._REQUISITION_DEFAULT_FIELDS.intersection(vals)
+        internal = relevant and self._is_internal()
+        result = super(StockPickingType, self).write(vals)
+        if relevant and (internal or self._is_internal()):
+            self._clear_requisition_default_cache()
+        return result
+
+    def unlink(self):
+        internal = self._is_internal()
+        result = super(StockPickingType, self).unlink()
+        if internal:
+            self._clear_requisition_default_cache()
+        return result
+
 class CustomStockQuant(models.Model):
     _name = 'custom.stock.quant'
     _rec_name = 'product_id'
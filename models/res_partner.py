@@ -1,24 +1,183 @@
 from odoo import models, fields, api, _
 import xmlrpc.client
 from odoo.exceptions import ValidationError
+from collections import defaultdict
 import logging
 
 _logger = logging.getLogger(__name__)
 
+# Fields sent by _prepare_partner_data that should be propagated when changed
+REMOTE_SYNC_FIELDS = {
+    'name', 'email', 'phone', 'is_company', 'company_type', 'mobile', 'street', 'street2', 'city', 'zip',
+    'country_id', 'vat', 'property_account_receivable_id', 'property_account_payable_id',
+}
+
+# Contacts claimed per batch when the cron is not run through remote.sync.channel
+PARTNER_BATCH_SIZE = 200
+
 class ResPartnerSync(models.Model):
     _inherit = 'res.partner'
 
     sent_to_remote = fields.Boolean(string="Sent to Remote", default=False)
+    remote_payload_hash = fields.Char(string="Remote Payload Hash", copy=False, readonly=True)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        partners = super(ResPartnerSync, self).create(vals_list)
+        self.env['remote.sync.job'].sudo()._enqueue_eligible(partners, 'partner')
+        return partners
+
+    def write(self, vals):
+        result = super(ResPartnerSync, self).write(vals)
+        if REMOTE_SYNC_FIELDS.intersection(vals):
+            self.env['remote.sync.job'].sudo()._enqueue(self.filtered('sent_to_remote'), 'partner', 'update')
+        return result
 
     @api.model
     def action_send_partners_to_remote_cron(self):
-        # Find all res.partner records that are not sent to remote
-        partners_to_send = self.search([('sent_to_remote', '=', False)], limit=10)
-        for partner in partners_to_send:
-            _logger.info("Processing partner: %s", partner.name)
-            partner.send_partner_to_remote()
-            partner.sent_to_remote = True
-            _logger.info("Done processing partner: %s", partner.name)
+        # Consume the contacts queued for the remote, in bulk
+        job_obj = self.env['remote.sync.job'].sudo()
+        jobs = job_obj._claim_jobs('partner', limit=PARTNER_BATCH_SIZE, actions=('create', 'update'))
+        partners = jobs._get_records('res.partner')
+        if partners:
+            try:
+                partners._send_partners_to_remote_bulk()
+            except Exception as e:
+                _logger.error("Error sending %s partners to remote: %s", len(partners), str(e))
+                job_obj._record_failed(partners, e)
+        jobs.filtered(lambda j: j.state == 'running')._set_done()
+
+    def _send_partners_to_remote_bulk(self):
+        """ Create or update the contacts of ``self`` on the remote with a few
+        calls for the whole batch: one search per referenced model, one
+        ``create`` for the new contacts and one ``write`` per set of changed
+        values for the existing ones.
+
+        Contacts a bulk call fails for are sent one by one, so that a single
+        invalid contact does not fail the others.
+        """
+        config_parameters = self.env['ir.config_parameter'].sudo()
+        url = config_parameters.get_param('remote_operations.url')
+        db = config_parameters.get_param('remote_operations.db')
+        username = config_parameters.get_param('remote_operations.username')
+        password = config_parameters.get_param('remote_operations.password')
+        if not all([url, db, username, password]):
+            raise ValidationError("Remote server settings must be fully configured (URL, DB, Username, Password)")
+
+        models = self.env['remote.connection']._get_client(url, db, username, password)
+        uid = models.uid
+        id_map = self.env['remote.id.map']
+        job_obj = self.env['remote.sync.job'].sudo()
+
+        # Referenced records, one search per model
+        id_map._prefetch(models, 'res.country', self.country_id)
+        accounts = self.property_account_receivable_id | self.property_account_payable_id
+        account_ids = {}
+        codes = list(set(code for code in accounts.mapped('code') if code))
+        if codes:
+            for account in models.execute_kw(db, uid, password, 'account.account', 'search_read',
+                                             [[('code', 'in', codes)]], {'fields': ['id', 'code']}):
+                account_ids.setdefault(account['code'], account['id'])
+
+        payloads = {}
+        for partner in self:
+            partner_data = partner._prepare_partner_data(models, db, uid, password, partner, account_ids=account_ids)
+            payload_hash = self.env['remote.connection']._payload_hash(partner_data)
+            if partner.sent_to_remote and payload_hash == partner.remote_payload_hash:
+                continue  # Up to date on remote
+            payloads[partner.id] = (partner_data, payload_hash)
+        if not payloads:
+            self.write({'sent_to_remote': True})
+            return
+        to_send = self.browse(list(payloads))
+
+        # Existing remote contacts: the stored mappings, then one search by name for the others
+        remote_ids = id_map._lookup_many(models, to_send)
+        names = list(set(name for name in to_send.filtered(lambda p: p.id not in remote_ids).mapped('name') if name))
+        if names:
+            remote_by_name = {}
+            for remote_partner in models.execute_kw(db, uid, password, 'res.partner', 'search_read',
+                                                    [[('name', 'in', names)]], {'fields': ['id', 'name']}):
+                remote_by_name.setdefault(remote_partner['name'], remote_partner['id'])
+            for partner in to_send.filtered(lambda p: p.id not in remote_ids and p.name in remote_by_name):
+                remote_ids[partner.id] = remote_by_name[partner.name]
+                id_map._store(models, partner, remote_ids[partner.id])
+
+        # Only write the values that differ, so contacts needing the same change share a call
+        changes = defaultdict(list)
+        existing = to_send.filtered(lambda p: p.id in remote_ids)
+        if existing:
+            field_names = list(next(iter(payloads.values()))[0])
+            remote_values = {
+                remote_partner['id']: remote_partner
+                for remote_partner in models.execute_kw(db, uid, password, 'res.partner', 'read',
+                                                        [list(set(remote_ids[p.id] for p in existing))],
+                                                        {'fields': field_names})
+            }
+            for partner in existing:
+                remote_partner = remote_values.get(remote_ids[partner.id], {})
+                diff = {
+                    name: value for name, value in payloads[partner.id][0].items()
+                    if self._normalize_remote_value(value) != self._normalize_remote_value(remote_partner.get(name))
+                }
+                if diff:
+                    changes[tuple(sorted(diff.items()))].append(partner.id)
+
+        sent = existing.filtered(lambda p: not any(p.id in ids for ids in changes.values()))
+        retry = self.browse()
+        # Contacts sharing a name are matched by name, like the one by one sync does, so only create one of them;
+        # contacts without a name (e.g. addresses) each get their own remote contact
+        new_partners = {}
+        for partner in to_send - existing:
+            key = partner.name or ('id', partner.id)
+            new_partners.setdefault(key, self.browse())
+            new_partners[key] |= partner
+        if new_partners:
+            created = self.browse([partners[0].id for partners in new_partners.values()])
+            try:
+                new_ids = models.execute_kw(db, uid, password, 'res.partner', 'create',
+                                            [[payloads[partner.id][0] for partner in created]])
+            except Exception as e:
+                _logger.warning("Bulk creation of %s partners failed, sending them one by one: %s", len(created), str(e))
+                retry |= to_send - existing
+            else:
+                for partners, remote_id in zip(new_partners.values(), new_ids):
+                    for partner in partners:
+                        id_map._store(models, partner, remote_id)
+                    sent |= partners
+                _logger.info("Created %s new partners.", len(created))
+
+        for diff, partner_ids in changes.items():
+            partners = self.browse(partner_ids)
+            try:
+                models.execute_kw(db, uid, password, 'res.partner', 'write',
+                                  [[remote_ids[partner.id] for partner in partners], dict(diff)])
+            except Exception as e:
+                _logger.warning("Bulk update of %s partners failed, sending them one by one: %s", len(partners), str(e))
+                retry |= partners
+            else:
+                sent |= partners
+        if changes:
+            _logger.info("Updated %s partners in %s calls.", sum(len(ids) for ids in changes.values()), len(changes))
+
+        for partner in sent:
+            partner.write({'remote_payload_hash': payloads[partner.id][1]})
+        for partner in retry:
+            try:
+                partner.send_partner_to_remote()
+            except Exception as e:
+                _logger.error("Error processing partner ID %s: %s", partner.id, str(e))
+                job_obj._record_failed(partner, e)
+                continue
+            sent |= partner
+        (sent | (self - to_send)).write({'sent_to_remote': True})
+
+    @api.model
+    def _normalize_remote_value(self, value):
+        """ Bring a contact value read from the remote or built for it to a comparable form. """
+        if isinstance(value, (list, tuple)) and len(value) == 2 and isinstance(value[0], int):
+            return value[0]  # Many2one read as (id, display name)
+        return value or False
 
     def send_partner_to_remote(self):
         # Get configuration parameters
@@ -34,16 +193,20 @@ class ResPartnerSync(models.Model):
 
         # Create XML-RPC connection and send data
         try:
-            common = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/common', allow_none=True)
-            uid = common.authenticate(db, username, password, {})
-            models = xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/object', allow_none=True)
+            models = self.env['remote.connection']._get_client(url, db, username, password)
+            uid = models.uid
 
             # Prepare contact data
             partner_data = self._prepare_partner_data(models, db, uid, password, self)
+            payload_hash = self.env['remote.connection']._payload_hash(partner_data)
+            if self.sent_to_remote and payload_hash == self.remote_payload_hash:
+                _logger.info("Partner %s is up to date on remote, skipping.", self.name)
+                return
 
-            # Check if the contact already exists in the remote database
+            # Check if the contact already exists in the remote database: mapped
+            # first, searched by name only when it has no mapping yet
             remote_partner_id = self._get_remote_id_if_set(
-                models, db, uid, password, 'res.partner', 'name', self.name
+                models, db, uid, password, 'res.partner', 'name', self
             )
             
             if remote_partner_id:
@@ -52,19 +215,27 @@ class ResPartnerSync(models.Model):
                 _logger.info("Updated partner: %s", self.name)
             else:
                 # Create new contact
-                new_partner_id = models.execute_kw(db, uid, password, 'res.partner', 'create', [partner_data])
+                remote_partner_id = models.execute_kw(db, uid, password, 'res.partner', 'create', [partner_data])
                 _logger.info("Created new partner: %s", self.name)
 
+            self.env['remote.id.map']._store(models, self, remote_partner_id)
+            self.write({'remote_payload_hash': payload_hash})
+
         except Exception as e:
             raise ValidationError(f"Error while sending contact data to remote server: {e}")
 
-    def _prepare_partner_data(self, models, db, uid, password, partner):
+    def _prepare_partner_data(self, models, db, uid, password, partner, account_ids=None):
         # Prepare data to match the remote contact fields
-        account_receivable_id_to_check = self.property_account_receivable_id.code
-        account_payable_to_check = self.property_account_payable_id.code
+        account_receivable_id_to_check = partner.property_account_receivable_id.code
+        account_payable_to_check = partner.property_account_payable_id.code
 
-        property_account_receivable_id = self._get_remote_id(models, db, uid, password, 'account.account', 'code', account_receivable_id_to_check)
-        property_account_payable_id = self._get_remote_id(models, db, uid, password, 'account.account', 'code', account_payable_to_check)
+        if account_ids is not None:
+            # Already resolved for the whole batch by _send_partners_to_remote_bulk
+            property_account_receivable_id = account_ids.get(account_receivable_id_to_check)
+            property_account_payable_id = account_ids.get(account_payable_to_check)
+        else:
+            property_account_receivable_id = self._get_remote_id(models, db, uid, password, 'account.account', 'code', account_receivable_id_to_check)
+            property_account_payable_id = self._get_remote_id(models, db, uid, password, 'account.account', 'code', account_payable_to_check)
 
         return {
             'name': partner.name,
@@ -90,7 +261,10 @@ class ResPartnerSync(models.Model):
     
     def _get_remote_id_if_set(self, models, db, uid, password, model, field_name, field):
         if hasattr(field, 'name'):  # Check if the field is a recordset with a 'name' attribute
-            return self._get_remote_id(models, db, uid, password, model, field_name, field.name)
+            return self.env['remote.id.map']._resolve(
+                models, field,
+                lambda: self._get_remote_id(models, db, uid, password, model, field_name, field.name)
+            )
         elif isinstance(field, str):  # Handle the case where field is a string
             return self._get_remote_id(models, db, uid, password, model, field_name, field)
         return False